@@ -4,9 +4,24 @@ in a Python program to provide an internal command language.
 """
 
 import sys
+import os
+import io
+import hashlib
+import pickle
 import re
 import functools
+import collections
+import collections.abc
+import numbers
+import itertools
+import operator
 import traceback
+import contextlib
+import weakref
+import time
+import threading
+import asyncio
+import concurrent.futures
 
 class LispError(Exception):
     def __init__(self, msg):
@@ -24,9 +39,109 @@ class LispReadError(LispError):
 class LispParseError(LispError):
     pass
 
+class LispResourceError(LispError):
+    pass
+
 class LispQuit(Exception):
     pass
 
+
+# EVALUATION BUDGETS
+#
+# An evaluation run with a budget charges the meter of its thread one
+# step for every evaluation step, every function or primitive application
+# and every element realized from a lazy sequence. It also charges the
+# cons cells (and vector slots), string characters and dictionary entries
+# it creates.
+# The evaluator tests the number of active meters first, so evaluation
+# without a budget only pays for reading a global.
+
+_active_meters = 0
+_meters_lock = threading.Lock()
+_meter_local = threading.local()
+
+_RESOURCES = {
+    'steps': 'steps',
+    'cons_cells': 'cons cells',
+    'string_chars': 'string characters',
+    'dict_entries': 'dictionary entries'
+}
+
+class _Meter:
+    """
+    What is left of each resource of a budget, None for no limit.
+    """
+    def __init__(self, limits):
+        self.limits = limits
+        for (resource, limit) in limits.items():
+            setattr(self, resource, limit)
+
+    def exceeded(self, resource):
+        return LispResourceError('Evaluation exceeded its limit of {} {}'.format(self.limits[resource], _RESOURCES[resource]))
+
+def _charge():
+    meter = getattr(_meter_local, 'meter', None)
+    if meter is not None and meter.steps is not None:
+        meter.steps -= 1
+        if meter.steps < 0:
+            raise meter.exceeded('steps')
+
+def _allocate(resource, n):
+    meter = getattr(_meter_local, 'meter', None)
+    if meter is not None:
+        left = getattr(meter, resource)
+        if left is not None:
+            setattr(meter, resource, left - n)
+            if left < n:
+                raise meter.exceeded(resource)
+
+@contextlib.contextmanager
+def _unmetered():
+    """
+    Run the body outside of any budget, for reading and parsing.
+    """
+    meter = getattr(_meter_local, 'meter', None)
+    _meter_local.meter = None
+    try:
+        yield
+    finally:
+        _meter_local.meter = meter
+
+@contextlib.contextmanager
+def _metered(**limits):
+    """
+    Run the body with a budget, given as a limit for (some of) the
+    resources in _RESOURCES. A nested budget cannot exceed what is
+    left of the enclosing one, and what it uses is charged to the
+    enclosing one as well.
+    """
+    global _active_meters
+    outer = getattr(_meter_local, 'meter', None)
+    for resource in _RESOURCES:
+        limit = limits.get(resource)
+        left = None if outer is None else getattr(outer, resource)
+        if left is not None:
+            left = max(left, 0)
+            limit = left if limit is None else min(limit, left)
+        limits[resource] = limit
+    meter = _Meter(limits)
+    _meter_local.meter = meter
+    with _meters_lock:
+        _active_meters += 1
+    try:
+        yield meter
+    finally:
+        with _meters_lock:
+            _active_meters -= 1
+        _meter_local.meter = outer
+        if outer is not None:
+            for resource in _RESOURCES:
+                left = getattr(outer, resource)
+                if left is not None:
+                    used = limits[resource] - max(getattr(meter, resource), 0)
+                    setattr(outer, resource, left - used)
+
+
 def canonical(s):
     return s.lower()
 
@@ -35,6 +150,8 @@ class Environment:
     def __init__(self, bindings=[], previous=None):
         self._previous = previous
         self._bindings = {}
+        # specialized functions depending on bindings of this environment
+        self._watchers = None
         for(name, value) in bindings:
             self.add(name, value)
 
@@ -45,6 +162,8 @@ class Environment:
         """
         symbol = canonical(symbol)
         self._bindings[symbol] = value
+        if self._watchers and symbol in self._watchers:
+            self._notify(symbol)
 
     def update(self, symbol, value):
         """
@@ -56,6 +175,8 @@ class Environment:
         symbol = canonical(symbol)
         if symbol in self._bindings:
             self._bindings[symbol] = value
+            if self._watchers and symbol in self._watchers:
+                self._notify(symbol)
             return True
         updated = self._previous and self._previous.update(symbol, value)
         if not updated:
@@ -73,6 +194,19 @@ class Environment:
             return self._previous.lookup(symbol)
         raise LispError('Cannot find binding for `{}`'.format(symbol))
 
+    def watch(self, symbol, function):
+        """
+        Revert a specialized function to its generic body
+        when symbol is bound again in this environment.
+        """
+        if self._watchers is None:
+            self._watchers = {}
+        self._watchers.setdefault(symbol, weakref.WeakSet()).add(function)
+
+    def _notify(self, symbol):
+        for function in list(self._watchers.pop(symbol)):
+            function.despecialize()
+
     def bindings(self):
         return list(self._bindings.items())
 
@@ -80,6 +214,41 @@ class Environment:
         return self._previous
 
 
+# Type tags: one bit per built-in kind, so that the
+# composite predicates (is_list, is_atom, ...) are a single mask test
+TAG_NUMBER = 1
+TAG_BOOLEAN = 2
+TAG_STRING = 4
+TAG_SYMBOL = 8
+TAG_NIL = 16
+TAG_EMPTY = 32
+TAG_CONS = 64
+TAG_PRIMITIVE = 128
+TAG_FUNCTION = 256
+TAG_VECTOR = 512
+TAG_LAZY = 1024
+TAG_PYOBJECT = 2048
+
+TAG_ANY_ATOM = TAG_NUMBER | TAG_SYMBOL | TAG_STRING | TAG_BOOLEAN
+TAG_ANY_LIST = TAG_EMPTY | TAG_CONS
+TAG_ANY_FUNCTION = TAG_PRIMITIVE | TAG_FUNCTION
+
+_KIND_TAGS = {
+    'number': TAG_NUMBER,
+    'boolean': TAG_BOOLEAN,
+    'string': TAG_STRING,
+    'symbol': TAG_SYMBOL,
+    'nil': TAG_NIL,
+    'empty-list': TAG_EMPTY,
+    'cons-list': TAG_CONS,
+    'primitive': TAG_PRIMITIVE,
+    'function': TAG_FUNCTION,
+    'vector': TAG_VECTOR,
+    'lazy-seq': TAG_LAZY,
+    'py-object': TAG_PYOBJECT
+}
+
+
 class Value:
 
     def to_list(self, error=True):
@@ -99,58 +268,152 @@ class Value:
         Transforms a Python tree  of values into a LISP list of values
         """
         if type(struct) == type([]):
-            result = VEmpty()
-            for r in reversed(struct):
-                result = VCons(Value.from_tree(r), result)
-            return result
+            builder = _ListBuilder()
+            for r in struct:
+                builder.append(Value.from_tree(r))
+            return builder.finish()
         else:
             return struct
 
-    def _str_cdr(self):
-        raise LispError('Cannot use value as list terminator: {}'.format(self))
+    @staticmethod
+    def from_python(obj):
+        """
+        Transforms a Python value into a LISP value:
+        booleans, numbers, strings and None map to the corresponding
+        atoms, lists and tuples to LISP lists, and dicts to dictionaries.
+        Values are returned unchanged.
+        """
+        if isinstance(obj, Value):
+            return obj
+        if obj is None:
+            return VNil()
+        if isinstance(obj, bool):
+            return VBoolean(obj)
+        if isinstance(obj, (int, float)):
+            return VNumber(obj)
+        if isinstance(obj, str):
+            return VString(obj)
+        if isinstance(obj, (list, tuple)):
+            builder = _ListBuilder()
+            for r in obj:
+                builder.append(Value.from_python(r))
+            return builder.finish()
+        if isinstance(obj, dict):
+            return VDict([ (Value.from_python(k), Value.from_python(v)) for (k, v) in obj.items() ])
+        raise LispError('Cannot convert Python value {!r}'.format(obj))
+
+    def to_python(self):
+        """
+        Transforms a LISP value into a Python value, the inverse of from_python.
+        Values without a Python counterpart (e.g., functions) are returned unchanged.
+        """
+        return self
+
+    def write_layout(self):
+        """
+        Describe how to print a composite value, as a tuple
+        (opening text, iterable of items, closing text), where
+        items are written separated by spaces. An item is either
+        a Value or such a tuple itself.
+        Return None for values printed using str().
+        """
+        return None
+
+    def write(self, stream, max_length=None, max_depth=None):
+        """
+        Write the value to a text stream.
+        Printing is iterative, so long or deeply nested values
+        do not hit the recursion limit. Composites print at most
+        max_length items and are cut off below max_depth levels,
+        and a value containing itself prints as `...` where the
+        cycle closes.
+        """
+        _write_value(self, stream, max_length, max_depth)
+
+    def to_string(self, max_length=None, max_depth=None):
+        stream = io.StringIO()
+        self.write(stream, max_length, max_depth)
+        return stream.getvalue()
 
     def display(self):
         return str(self)
 
-    def pp(self, prefix=0, suffix='', skip_prefix=False):
-        if skip_prefix:
-            return str(self) + suffix
-        else:
-            return(' ' * prefix) + str(self) + suffix
+    def pp(self, prefix=0, suffix='', skip_prefix=False, width=80):
+        """
+        Pretty print the value to a string indented by prefix,
+        with suffix appended.
+        """
+        stream = io.StringIO()
+        if not skip_prefix:
+            stream.write(' ' * prefix)
+        self.pretty_write(stream, width=width, column=prefix)
+        stream.write(suffix)
+        return stream.getvalue()
+
+    def pretty_write(self, stream, width=80, column=0):
+        """
+        Write the value to a text stream starting at the given column.
+        A composite that fits in the remaining width is written on one
+        line, otherwise its items are written one per line, aligned
+        after its opening text. Composites are described by write_layout().
+        """
+        _pp_render(_pp_document(self), stream, width, column)
+
+    # Type tag of the class, one of the TAG_ constants below.
+    # A subclass that only overrides kind() gets tag 0, and the
+    # predicates then fall back to looking up its kind() string.
+    _tag = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'kind' in cls.__dict__ and '_tag' not in cls.__dict__:
+            cls._tag = 0
+
+    def type_tag(self):
+        return self._tag or _KIND_TAGS.get(self.kind(), 0)
 
     def kind(self):
         return None
 
     def is_number(self):
-        return self.kind() == 'number'
+        return (self._tag or self.type_tag()) == TAG_NUMBER
 
     def is_boolean(self):
-        return self.kind() == 'boolean'
+        return (self._tag or self.type_tag()) == TAG_BOOLEAN
 
     def is_string(self):
-        return self.kind() == 'string'
+        return (self._tag or self.type_tag()) == TAG_STRING
 
     def is_symbol(self):
-        return self.kind() == 'symbol'
+        return (self._tag or self.type_tag()) == TAG_SYMBOL
 
     def is_nil(self):
-        return self.kind() == 'nil'
+        return (self._tag or self.type_tag()) == TAG_NIL
 
     def is_empty(self):
-        return self.kind() == 'empty-list'
+        return (self._tag or self.type_tag()) == TAG_EMPTY
     
     def is_cons(self):
-        return self.kind() == 'cons-list'
+        return (self._tag or self.type_tag()) == TAG_CONS
+
+    def is_vector(self):
+        return (self._tag or self.type_tag()) == TAG_VECTOR
+
+    def is_lazy(self):
+        return (self._tag or self.type_tag()) == TAG_LAZY
+
+    def is_pyobject(self):
+        return (self._tag or self.type_tag()) == TAG_PYOBJECT
 
     def is_function(self):
-        return self.kind() in('primitive', 'function')
+        return bool((self._tag or self.type_tag()) & TAG_ANY_FUNCTION)
 
     def is_atom(self):
         # only really makes sense for things that are readable
-        return self.kind() in ['number', 'symbol', 'string', 'boolean']
+        return bool((self._tag or self.type_tag()) & TAG_ANY_ATOM)
 
     def is_list(self):
-        return self.kind() in ['empty-list', 'cons-list']
+        return bool((self._tag or self.type_tag()) & TAG_ANY_LIST)
     
     def is_true(self):
         return True
@@ -159,11 +422,21 @@ class Value:
         # by default, do pointer equality
         return id(self) == id(v)
 
+    def hash_key(self):
+        """
+        Return a hashable Python key such that two values have the
+        same key exactly when they are equal according to is_equal.
+        Return None if the value cannot be hashed (e.g., it is mutable).
+        """
+        return None
+
     def apply(self, args):
         raise LispError('Cannot apply value {}'.format(self))
 
     
 class VBoolean(Value):
+    _tag = TAG_BOOLEAN
+
     def __init__(self, b):
         self._value = b
 
@@ -179,15 +452,30 @@ class VBoolean(Value):
     def value(self):
         return self._value
 
+    def to_python(self):
+        return self._value
+
     def is_true(self):
         return self._value
         
     def is_equal(self, v):
         return v.is_boolean() and self.value() == v.value()
 
+    def hash_key(self):
+        return (TAG_BOOLEAN, self._value)
+
+
+# booleans are immutable, so primitives can share these
+_TRUE = VBoolean(True)
+_FALSE = VBoolean(False)
+
     
 class VString(Value):
+    _tag = TAG_STRING
+
     def __init__(self, s):
+        if _active_meters:
+            _allocate('string_chars', len(s))
         self._value = s
 
     def __repr__(self):
@@ -204,15 +492,23 @@ class VString(Value):
 
     def value(self):
         return self._value
+
+    def to_python(self):
+        return self._value
         
     def is_true(self):
         return not(not self._value)
         
     def is_equal(self, v):
         return v.is_string() and self.value() == v.value()
+
+    def hash_key(self):
+        return (TAG_STRING, self._value)
     
     
 class VNumber(Value):
+    _tag = TAG_NUMBER
+
     def __init__(self, v):
         self._value = v
 
@@ -228,14 +524,22 @@ class VNumber(Value):
     def value(self):
         return self._value
 
+    def to_python(self):
+        return self._value
+
     def is_true(self):
         return not(not self._value)
         
     def is_equal(self, v):
         return v.is_number() and self.value() == v.value()
 
+    def hash_key(self):
+        return (TAG_NUMBER, self._value)
+
 
 class VNil(Value):
+    _tag = TAG_NIL
+
     def __repr__(self):
         return 'VNil()'
 
@@ -251,11 +555,19 @@ class VNil(Value):
     def value(self):
         return None
 
+    def to_python(self):
+        return None
+
     def is_equal(self, v):
         return v.is_nil()
 
+    def hash_key(self):
+        return (TAG_NIL,)
+
 
 class VEmpty(Value):
+    _tag = TAG_EMPTY
+
     def __repr__(self):
         return 'VEmpty()'
 
@@ -265,9 +577,6 @@ class VEmpty(Value):
     def __str__(self):
         return '()'
 
-    def _str_cdr(self):
-        return ')'
-
     def kind(self):
         return 'empty-list'
 
@@ -277,21 +586,35 @@ class VEmpty(Value):
     def value(self):
         return None
 
+    def to_python(self):
+        return []
+
     def is_equal(self, v):
         return v.is_empty()
 
+    def hash_key(self):
+        return (TAG_EMPTY,)
+
+
+# the empty list is immutable, so it can be shared
+_EMPTY = VEmpty()
+
     
 class VCons(Value):
+    _tag = TAG_CONS
+
     def __init__(self, car, cdr):
-        if not cdr.is_list():
+        if not (cdr._tag or cdr.type_tag()) & TAG_ANY_LIST:
             raise LispError('List required as second cons argument')
+        if _active_meters:
+            _allocate('cons_cells', 1)
         self._car = car
         self._cdr = cdr
 
     def to_list(self, error=True):
         curr = self
         result = []
-        while curr.kind() == 'cons-list':
+        while curr.is_cons():
             result.append(curr.car())
             curr = curr.cdr()
         return result
@@ -300,30 +623,31 @@ class VCons(Value):
         return 'VCons({},{})'.format(repr(self._car), repr(self._cdr))
 
     def __str__(self):
-        return '({}{}'.format(self._car, self._cdr._str_cdr())
+        return self.to_string()
 
-    def _str_cdr(self):
-        return ' {}{}'.format(self._car, self._cdr._str_cdr())
+    def write_layout(self):
+        return ('(', self._cars(), ')')
+
+    def _cars(self):
+        curr = self
+        while curr.is_cons():
+            yield curr.car()
+            curr = curr.cdr()
 
-    def pp(self, prefix=0, suffix='', skip_prefix=False):
-        result = ''
-        if not skip_prefix:
-            result += ' ' * prefix
-        result += '('
-        lst = self.to_list()
-        for i, v in enumerate(lst):
-            skip =(i == 0)
-            last =(i == len(lst) - 1)
-            sub_suffix = ')' + suffix if last else '\n'
-            result += v.pp(prefix=prefix + 1, skip_prefix=skip, suffix=sub_suffix)
-        return result
-    
     def kind(self):
         return 'cons-list'
 
     def value(self):
         return(self._car, self._cdr)
 
+    def to_python(self):
+        result = []
+        current = self
+        while current.is_cons():
+            result.append(current._car.to_python())
+            current = current._cdr
+        return result
+
     def car(self):
         return self._car
 
@@ -332,14 +656,389 @@ class VCons(Value):
 
     def is_equal(self, v):
         return v.is_cons() and self.car().is_equal(v.car()) and self.cdr().is_equal(v.cdr())
+
+    def hash_key(self):
+        keys = []
+        curr = self
+        while curr.is_cons():
+            key = curr.car().hash_key()
+            if key is None:
+                return None
+            keys.append(key)
+            curr = curr.cdr()
+        return (TAG_CONS, tuple(keys))
     
 
+class _ListBuilder:
+    """
+    Build a LISP list front to back, by linking each new cons cell
+    into the tail of the previous one. The cells are mutated only
+    while the list is private to the builder, and are created
+    without re-checking that their cdr is a list.
+    """
+    __slots__ = ('_head', '_last')
+
+    def __init__(self):
+        self._head = None
+        self._last = None
+
+    def append(self, v):
+        if _active_meters:
+            _allocate('cons_cells', 1)
+        cell = VCons.__new__(VCons)
+        cell._car = v
+        cell._cdr = _EMPTY
+        if self._last is None:
+            self._head = cell
+        else:
+            self._last._cdr = cell
+        self._last = cell
+
+    def extend(self, values):
+        for v in values:
+            self.append(v)
+
+    def finish(self, tail=None):
+        """
+        Return the list built, ending with tail (a list) if given.
+        """
+        if tail is not None:
+            if self._last is None:
+                return tail
+            self._last._cdr = tail
+        return self._head if self._head is not None else _EMPTY
+
+
+def _build_list(items):
+    """
+    Build a LISP list from a Python iterable, consuming it one
+    element at a time, so allocation quotas apply as the list grows.
+    """
+    builder = _ListBuilder()
+    builder.extend(items)
+    return builder.finish()
+
+
+class VVector(Value):
+    _tag = TAG_VECTOR
+
+    def __init__(self, values):
+        # values is a Python list, owned by the vector
+        if _active_meters:
+            # slots count against the same quota as cons cells
+            _allocate('cons_cells', len(values))
+        self._values = values
+
+    def __repr__(self):
+        return 'VVector({})'.format(self._values)
+
+    def __str__(self):
+        if not self._values:
+            return '#(vector)'
+        return self.to_string()
+
+    def write_layout(self):
+        if not self._values:
+            return None
+        return ('#(vector ', self._values, ')')
+
+    def kind(self):
+        return 'vector'
+
+    def value(self):
+        return self._values
+
+    def to_python(self):
+        return [ v.to_python() for v in self._values ]
+
+    def length(self):
+        return len(self._values)
+
+    def ref(self, idx):
+        if idx < 0 or idx >= len(self._values):
+            raise LispError('Index {} out of range of vector'.format(idx))
+        return self._values[idx]
+
+    def set(self, idx, v):
+        if idx < 0 or idx >= len(self._values):
+            raise LispError('Index {} out of range of vector'.format(idx))
+        self._values[idx] = v
+
+    def is_equal(self, v):
+        if not v.is_vector() or v.length() != len(self._values):
+            return False
+        return all(x.is_equal(y) for (x, y) in zip(self._values, v.value()))
+
+
+_NO_VALUE = object()
+
+class VLazySeq(Value):
+    _tag = TAG_LAZY
+
+    def __init__(self, source):
+        # source is a Python iterator of Values, handed over to the
+        # rest of the sequence once the first element is realized
+        self._source = source
+        self._cell = None
+        self._error = None
+
+    def __repr__(self):
+        return 'VLazySeq({})'.format('realized' if self._cell is not None else 'unrealized')
+
+    def __str__(self):
+        h = id(self)
+        return '#[lazy-seq {}]'.format(hex(h))
+
+    def kind(self):
+        return 'lazy-seq'
+
+    def value(self):
+        return self._cell
+
+    def _force(self):
+        """
+        Realize the first cell of the sequence: () when the sequence
+        is exhausted, and (first, rest) otherwise. An error raised by
+        the source is cached and raised again on every later force.
+        """
+        if self._error is not None:
+            raise self._error
+        if self._cell is None:
+            if _active_meters:
+                _charge()
+            try:
+                item = next(self._source, _NO_VALUE)
+            except Exception as e:
+                # a failed generator is finished: remember the error so
+                # that later forces report it instead of an empty tail
+                self._error = e
+                self._source = None
+                raise
+            if item is _NO_VALUE:
+                self._cell = ()
+            else:
+                self._cell = (item, self._tail(self._source))
+            self._source = None
+        return self._cell
+
+    def _tail(self, source):
+        return VLazySeq(source)
+
+    def is_exhausted(self):
+        return not self._force()
+
+    def car(self):
+        cell = self._force()
+        if not cell:
+            raise LispError('Cannot take first of an empty sequence')
+        return cell[0]
+
+    def cdr(self):
+        cell = self._force()
+        if not cell:
+            raise LispError('Cannot take rest of an empty sequence')
+        return cell[1]
+
+    def items(self):
+        curr = self
+        # do not keep the head of the sequence alive while iterating
+        del self
+        while True:
+            cell = curr._force()
+            if not cell:
+                return
+            yield cell[0]
+            curr = cell[1]
+
+
+class VOnePassSeq(VLazySeq):
+    """
+    A lazy sequence that can only be traversed once. First and rest
+    realize cells as usual, but a traversal (map, foldl, ...) streams
+    the elements left in the source without caching them, so the
+    head of the sequence does not keep them alive. The sequence cannot
+    be used any more once a traversal has started.
+    """
+
+    def __init__(self, source, traversed=None):
+        super().__init__(source)
+        # shared by all the cells of the sequence
+        self._traversed = traversed if traversed is not None else [False]
+
+    def _tail(self, source):
+        return VOnePassSeq(source, self._traversed)
+
+    def _check_fresh(self):
+        if self._traversed[0]:
+            raise LispError('One-pass sequence {} was already traversed'.format(self))
+
+    def _force(self):
+        self._check_fresh()
+        return super()._force()
+
+    def items(self):
+        self._check_fresh()
+        self._traversed[0] = True
+        return self._stream(self)
+
+    @staticmethod
+    def _stream(curr):
+        # cells realized before the traversal, then the rest of the source
+        while curr._cell is not None or curr._error is not None:
+            if curr._error is not None:
+                raise curr._error
+            if not curr._cell:
+                return
+            yield curr._cell[0]
+            curr = curr._cell[1]
+        while True:
+            if _active_meters:
+                _charge()
+            try:
+                item = next(curr._source, _NO_VALUE)
+            except Exception as e:
+                curr._error = e
+                curr._source = None
+                raise
+            if item is _NO_VALUE:
+                return
+            yield item
+
+
+class VPyObject(Value):
+    """
+    A Python object handed to LISP code as is, without conversion.
+    Elements read from it are wrapped in turn when they are accessed,
+    except for scalars, which become the corresponding atoms.
+    """
+    _tag = TAG_PYOBJECT
+
+    def __init__(self, obj):
+        self._object = obj
+
+    def __repr__(self):
+        return 'VPyObject({})'.format(type(self._object).__name__)
+
+    def __str__(self):
+        h = id(self._object)
+        return '#[py {} {}]'.format(type(self._object).__name__, hex(h))
+
+    @staticmethod
+    def wrap(obj):
+        if isinstance(obj, Value):
+            return obj
+        if obj is None or isinstance(obj, (bool, str)):
+            return Value.from_python(obj)
+        if isinstance(obj, numbers.Real):
+            return VNumber(obj)
+        if isinstance(obj, collections.abc.Iterator):
+            # one-shot iterators are only read once, through a lazy sequence
+            return VLazySeq(map(VPyObject.wrap, obj))
+        return VPyObject(obj)
+
+    def kind(self):
+        return 'py-object'
+
+    def value(self):
+        return self._object
+
+    def to_python(self):
+        return self._object
+
+    def is_true(self):
+        # empty containers are false, as in Python
+        try:
+            return bool(self._object)
+        except Exception as e:
+            raise LispError('Python object {} has no truth value: {}'.format(self, e))
+
+    def is_equal(self, v):
+        return v.is_pyobject() and v.value() is self._object
+
+    def get(self, key):
+        """
+        Look up a key or index, or an attribute of an object that cannot be subscripted.
+        Private and special attributes (starting with _) are not accessible,
+        since they would let scripts reach arbitrary Python code.
+        """
+        obj = self._object
+        try:
+            if isinstance(key, str) and not hasattr(type(obj), '__getitem__'):
+                if key.startswith('_'):
+                    raise LispError('Cannot access private attribute {!r} of {}'.format(key, self))
+                return VPyObject.wrap(getattr(obj, key))
+            return VPyObject.wrap(obj[key])
+        except (LookupError, AttributeError, TypeError):
+            raise LispError('Cannot find key {!r} in {}'.format(key, self))
+
+    def length(self):
+        try:
+            return len(self._object)
+        except TypeError:
+            raise LispError('Python object {} has no length'.format(self))
+
+    def items(self):
+        try:
+            return map(VPyObject.wrap, iter(self._object))
+        except TypeError:
+            raise LispError('Python object {} is not iterable'.format(self))
+
+    def _check_reusable(self):
+        if isinstance(self._object, collections.abc.Iterator):
+            raise LispError('Python iterator {} can only be read with py-iter'.format(self))
+
+    def is_exhausted(self):
+        self._check_reusable()
+        return next(self.items(), _NO_VALUE) is _NO_VALUE
+
+    def car(self):
+        self._check_reusable()
+        for v in self.items():
+            return v
+        raise LispError('Cannot take first of an empty sequence')
+
+    def cdr(self):
+        self._check_reusable()
+        items = self.items()
+        if next(items, _NO_VALUE) is _NO_VALUE:
+            raise LispError('Cannot take rest of an empty sequence')
+        return VLazySeq(items)
+
+    def ref(self, idx):
+        self._check_reusable()
+        obj = self._object
+        if idx >= 0:
+            if isinstance(obj, collections.abc.Mapping) or not hasattr(type(obj), '__getitem__'):
+                for v in itertools.islice(self.items(), idx, None):
+                    return v
+            else:
+                # sequences and arrays are indexed in place
+                try:
+                    return VPyObject.wrap(obj[idx])
+                except IndexError:
+                    pass
+        raise LispError('Index out of range of list')
+
+
 class VPrimitive(Value):
-    def __init__(self, name, primitive, min, max=None):
+    _tag = TAG_PRIMITIVE
+
+    def __init__(self, name, primitive, min, max=None, types=None, tail=None):
         self._name = name
         self._primitive = primitive
         self._min = min
         self._max = max
+        # when called from LISP code, a primitive with a tail function
+        # gets the function and arguments to call from it, and the
+        # evaluator makes that call in tail position
+        self._tail = tail
+        # a primitive with declared argument types has fixed arity, and is
+        # called with positional arguments through a generated wrapper
+        self._positional = None
+        if types is not None:
+            if min != len(types) or max != len(types):
+                raise LispError('Primitive {} with {} argument types must have arity {}'.format(name, len(types), len(types)))
+            self._positional = _positional_wrapper(name, primitive, types)
         
     def __repr__(self):
         return 'VPrimitive({})'.format(self._primitive.__name__)
@@ -354,16 +1053,33 @@ class VPrimitive(Value):
     def value(self):
         return self._primitive
 
-    def apply(self, values):
+    def check_arity(self, values):
         if len(values) < self._min:
             raise LispWrongArgNoError('Too few arguments {} to primitive {}'.format(len(values), self._name))
-        if self._max and len(values) > self._max:
+        if self._max is not None and len(values) > self._max:
             raise LispWrongArgNoError('Too many arguments {} to primitive {}'.format(len(values), self._name))
+
+    def tail_call(self, values):
+        """
+        Return the (function, arguments) this primitive calls in tail
+        position when applied to values.
+        """
+        self.check_arity(values)
+        return self._tail(self._name, values)
+
+    def apply(self, values):
+        if _active_meters:
+            _charge()
+        self.check_arity(values)
+        if self._positional:
+            return self._positional(*values)
         result = self._primitive(self._name, values)
         return(result or VNil())
     
     
 class VSymbol(Value):
+    _tag = TAG_SYMBOL
+
     def __init__(self, sym):
         self._symbol = canonical(sym)
 
@@ -379,15 +1095,28 @@ class VSymbol(Value):
     def value(self):
         return self._symbol
 
+    def to_python(self):
+        return self._symbol
+
     def is_equal(self, v):
         return v.is_symbol() and self.value() == v.value()
+
+    def hash_key(self):
+        return (TAG_SYMBOL, self._symbol)
     
     
 class VFunction(Value):
+    _tag = TAG_FUNCTION
+    # number of calls after which the body is specialized (None to never specialize)
+    hot_threshold = 100
+
     def __init__(self, params, body, env):
         self._params = params
         self._body = body
         self._env = env
+        # the body as parsed, when _body is a specialized version of it
+        self._generic = body
+        self._calls = 0
 
     def __repr__(self):
         return 'VFunction({}, {})'.format(self._params, repr(self._body))
@@ -399,6 +1128,11 @@ class VFunction(Value):
     def binding_env(self, values):
         if len(self._params) != len(values):
             raise LispWrongArgNoError('Wrong number of arguments to {}'.format(self))
+        if _active_meters:
+            _charge()
+        self._calls += 1
+        if self._calls == self.hot_threshold:
+            self.specialize()
         params_bindings = list(zip(self._params, values))
         new_env = Environment(previous=self._env)
         for(x, y) in params_bindings:
@@ -409,12 +1143,200 @@ class VFunction(Value):
         new_env = self.binding_env(values)
         return self._body.eval(new_env)
 
+    def specialize(self):
+        """
+        Replace the body with a version compiled for the current bindings
+        of the function's free variables (see _Specializer).
+        """
+        specializer = _Specializer(self._env)
+        code = specializer.compile(self._generic, ((frozenset(self._params), False),), True)
+        for (env, symbol) in specializer.dependencies():
+            env.watch(symbol, self)
+        self._body = _Specialized(code, self._generic)
+
+    def despecialize(self):
+        self._body = self._generic
+        self._calls = 0
+
+    def is_specialized(self):
+        return self._body is not self._generic
+
     def kind(self):
         return 'function'
 
     def value(self):
-        return(self._params, self._body, self._env)
+        return(self._params, self._generic, self._env)
+
+
+class VMemoized(VPrimitive):
+    """
+    A function wrapped with a cache of its results, keyed on the
+    hash_key() of its arguments, and evicting the least recently
+    used entry past max_size entries (None for no limit).
+    Calls with arguments that cannot be hashed are not cached.
+    """
+    def __init__(self, name, function, max_size=None):
+        super().__init__(name, self._call, 0, None)
+        self._function = function
+        self._max_size = max_size
+        self._cache = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __repr__(self):
+        return 'VMemoized({})'.format(repr(self._function))
+
+    def __str__(self):
+        h = id(self)
+        return '#[memo {}]'.format(hex(h))
+
+    def function(self):
+        return self._function
+
+    def _call(self, name, values):
+        keys = []
+        for v in values:
+            key = v.hash_key()
+            if key is None:
+                self._misses += 1
+                return self._function.apply(values)
+            keys.append(key)
+        key = tuple(keys)
+        cache = self._cache
+        if key in cache:
+            self._hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+        self._misses += 1
+        result = self._function.apply(values)
+        cache[key] = result
+        if self._max_size is not None and len(cache) > self._max_size:
+            cache.popitem(last=False)
+        return result
 
+    def stats(self):
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._cache),
+                'max-size': self._max_size}
+
+    def clear(self):
+        self._cache.clear()
+        self._hits = 0
+        self._misses = 0
+
+
+def _write_value(v, stream, max_length=None, max_depth=None):
+    write = stream.write
+    # one entry [items iterator, closing text, items written, id] per open composite
+    stack = []
+    open_ids = set()
+    item = v
+    while True:
+        if type(item) is tuple:
+            (layout, key) = (item, None)
+        else:
+            (layout, key) = (item.write_layout(), id(item))
+        if layout is None:
+            write(str(item))
+        elif key in open_ids or (max_depth is not None and len(stack) >= max_depth):
+            write('...')
+        else:
+            (opening, items, closing) = layout
+            write(opening)
+            open_ids.add(key)
+            stack.append([iter(items), closing, 0, key])
+        # move on to the next item to write, closing finished composites
+        item = None
+        while stack:
+            top = stack[-1]
+            item = next(top[0], None)
+            if item is not None and max_length is not None and top[2] >= max_length:
+                write(' ...' if top[2] else '...')
+                item = None
+            if item is None:
+                write(top[1])
+                stack.pop()
+                open_ids.discard(top[3])
+                continue
+            if top[2]:
+                write(' ')
+            top[2] += 1
+            break
+        if item is None:
+            return
+
+
+class _PPGroup:
+    __slots__ = ('opening', 'items', 'closing', 'size')
+
+    def __init__(self, opening, closing):
+        self.opening = opening
+        self.items = []
+        self.closing = closing
+        self.size = 0
+
+
+def _pp_document(v):
+    """
+    Build the layout tree of a value for pretty printing: strings
+    for leaves, and groups for composites annotated with the size
+    they take when written on a single line.
+    """
+    root = _PPGroup('', '')
+    stack = [(root, iter([v]), None)]
+    open_ids = set()
+    while stack:
+        (group, items, key) = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            open_ids.discard(key)
+            group.size = len(group.opening) + len(group.closing) + max(len(group.items) - 1, 0)
+            for sub in group.items:
+                group.size += len(sub) if type(sub) is str else sub.size
+            continue
+        if type(item) is tuple:
+            (layout, item_key) = (item, None)
+        else:
+            (layout, item_key) = (item.write_layout(), id(item))
+        if layout is None:
+            group.items.append(str(item))
+        elif item_key in open_ids:
+            group.items.append('...')
+        else:
+            sub = _PPGroup(layout[0], layout[2])
+            group.items.append(sub)
+            open_ids.add(item_key)
+            stack.append((sub, iter(layout[1]), item_key))
+    return root.items[0]
+
+
+def _pp_render(doc, stream, width, column):
+    write = stream.write
+    # entries are (doc, start column, width of closing text that follows, flat?)
+    work = [(doc, column, 0, False)]
+    while work:
+        (item, col, trail, flat) = work.pop()
+        if type(item) is str:
+            write(item)
+            continue
+        last = len(item.items) - 1
+        if flat or item.size + trail <= width - col:
+            write(item.opening)
+            work.append((item.closing, 0, 0, True))
+            for (i, sub) in enumerate(reversed(item.items)):
+                work.append((sub, 0, 0, True))
+                if i < last:
+                    work.append((' ', 0, 0, True))
+        else:
+            write(item.opening)
+            inner = col + len(item.opening)
+            work.append((item.closing, 0, 0, True))
+            for i in range(last, -1, -1):
+                work.append((item.items[i], inner, trail + len(item.closing) if i == last else 0, False))
+                if i > 0:
+                    work.append(('\n' + ' ' * inner, 0, 0, True))
 
 
 class Expression:
@@ -436,6 +1358,8 @@ class Expression:
         curr_env = env
 
         while(True):
+            if _active_meters:
+                _charge()
             (new_exp, new_env) = curr_exp.eval_partial(curr_env)
             if new_env is None:
                 # actually a value!
@@ -461,12 +1385,14 @@ class Symbol(Expression):
 class String(Expression):
     def __init__(self, s):
         self._string = s
+        # strings are immutable, so every evaluation returns the same value
+        self._value = VString(s)
 
     def __repr__(self):
         return 'String({})'.format(self._string)
                            
     def eval(self, env):
-        return VString(self._string)
+        return self._value
                             
     
 class Integer(Expression):
@@ -502,15 +1428,35 @@ class Apply(Expression):
 
     def eval_partial(self, env):
         f = self._fun.eval(env)
-        values = [ arg.eval(env) for arg in self._args ]
         if isinstance(f, VPrimitive):
-            return(f.apply(values), None)
-        elif isinstance(f, VFunction):
-            (_, body, _) = f.value()
-            new_env = f.binding_env(values)
-            return(body, new_env)
-        else:
-            raise LispError('Cannot apply value {}'.format(f))
+            call = f._positional
+            if call and len(self._args) == f._min:
+                # fixed arity: call directly without an argument list
+                args = self._args
+                if f._min == 1:
+                    return(call(args[0].eval(env)), None)
+                if f._min == 2:
+                    return(call(args[0].eval(env), args[1].eval(env)), None)
+                return(call(*[ arg.eval(env) for arg in args ]), None)
+        return _apply_partial(f, [ arg.eval(env) for arg in self._args ])
+
+
+def _apply_partial(f, values):
+    """
+    Apply f to values in tail position: calls to functions return
+    their body and environment for the evaluator to continue with.
+    """
+    if isinstance(f, VFunction):
+        return(f._body, f.binding_env(values))
+    if isinstance(f, VPrimitive):
+        while f._tail is not None:
+            (f, values) = f.tail_call(values)
+            if isinstance(f, VFunction):
+                return(f._body, f.binding_env(values))
+            if not isinstance(f, VPrimitive):
+                raise LispError('Cannot apply value {}'.format(f))
+        return(f.apply(values), None)
+    raise LispError('Cannot apply value {}'.format(f))
     
     
 class If(Expression):
@@ -588,6 +1534,204 @@ class Do(Expression):
         return(self._exprs[-1], env)
 
 
+# HOT FUNCTION SPECIALIZATION
+#
+# A function called VFunction.hot_threshold times has its body compiled
+# into nested Python closures. Parameters and local bindings are read
+# directly from the frame holding them, free variables from the
+# environment defining them, and primitives that are not shadowed are
+# called directly. Only tail calls go back through the evaluator loop.
+# The function watches every binding its free variables were resolved
+# through, and reverts to its generic body when one is rebound.
+
+class _Specialized(Expression):
+    def __init__(self, code, generic):
+        self._code = code
+        self._generic = generic
+
+    def __repr__(self):
+        return 'Specialized({})'.format(repr(self._generic))
+
+    def eval_partial(self, env):
+        return self._code(env)
+
+
+class _Specializer:
+    """
+    Compile an expression into a function of the environment. In tail
+    position, the compiled function follows the eval_partial protocol;
+    otherwise it returns a value. Scopes list the names bound by the
+    enclosing frames, innermost first, with a flag for LETREC frames.
+    """
+    def __init__(self, env):
+        self._env = env
+        self._dependencies = set()
+
+    def dependencies(self):
+        return self._dependencies
+
+    def compile(self, exp, scopes, tail):
+        kind = type(exp)
+        if kind is Symbol:
+            code = self.compile_symbol(exp, scopes)
+        elif kind is Integer:
+            v = VNumber(exp._value)
+            code = lambda env: v
+        elif kind is String:
+            v = exp._value
+            code = lambda env: v
+        elif kind is Boolean:
+            v = _TRUE if exp._value else _FALSE
+            code = lambda env: v
+        elif kind is Quote:
+            v = exp._sexpr
+            code = lambda env: v
+        elif kind is Lambda:
+            (params, body) = (exp._params, exp._expr)
+            code = lambda env: VFunction(params, body, env)
+        elif kind is If:
+            return self.compile_if(exp, scopes, tail)
+        elif kind is Do:
+            return self.compile_do(exp, scopes, tail)
+        elif kind is LetRec:
+            return self.compile_letrec(exp, scopes, tail)
+        elif kind is Apply:
+            code = self.compile_apply(exp, scopes, tail)
+            if code is None:
+                code = self.compile_call(exp, scopes, tail)
+            return code
+        else:
+            return exp.eval_partial if tail else exp.eval
+        if tail:
+            return lambda env: (code(env), None)
+        return code
+
+    def resolve(self, name):
+        """
+        Find the environment binding a free variable, watching every
+        environment on the way for a new binding that would shadow it.
+        """
+        env = self._env
+        while env is not None:
+            self._dependencies.add((env, name))
+            if name in env._bindings:
+                return env
+            env = env._previous
+        return None
+
+    def compile_symbol(self, exp, scopes):
+        name = exp._symbol
+        for (depth, (names, letrec)) in enumerate(scopes):
+            if name in names:
+                return self.compile_local(name, depth, letrec)
+        env = self.resolve(name)
+        if env is None or env._bindings[name] is None:
+            # not bound yet, or a LETREC binding being initialized
+            return exp.eval
+        bindings = env._bindings
+        return lambda env: bindings[name]
+
+    def compile_local(self, name, depth, letrec):
+        if depth == 0:
+            code = lambda env: env._bindings[name]
+        elif depth == 1:
+            code = lambda env: env._previous._bindings[name]
+        else:
+            def code(env):
+                for _ in range(depth):
+                    env = env._previous
+                return env._bindings[name]
+        if not letrec:
+            return code
+        def checked(env):
+            v = code(env)
+            if v is None:
+                raise LispError('Trying to access a non-initialized binding {} in a LETREC'.format(name))
+            return v
+        return checked
+
+    def compile_if(self, exp, scopes, tail):
+        cond = self.compile(exp._cond, scopes, False)
+        thn = self.compile(exp._then, scopes, tail)
+        els = self.compile(exp._else, scopes, tail)
+        return lambda env: thn(env) if cond(env).is_true() else els(env)
+
+    def compile_do(self, exp, scopes, tail):
+        if not exp._exprs:
+            if tail:
+                return lambda env: (VNil(), None)
+            return lambda env: VNil()
+        firsts = [ self.compile(e, scopes, False) for e in exp._exprs[:-1] ]
+        last = self.compile(exp._exprs[-1], scopes, tail)
+        if not firsts:
+            return last
+        def code(env):
+            for first in firsts:
+                first(env)
+            return last(env)
+        return code
+
+    def compile_letrec(self, exp, scopes, tail):
+        names = [ canonical(n) for (n, _) in exp._bindings ]
+        scopes = ((frozenset(names), True),) + scopes
+        inits = [ self.compile(e, scopes, False) for (_, e) in exp._bindings ]
+        body = self.compile(exp._expr, scopes, tail)
+        def code(env):
+            new_env = Environment(previous=env)
+            bindings = new_env._bindings
+            for n in names:
+                bindings[n] = None
+            vs = [ init(new_env) for init in inits ]
+            for (n, v) in zip(names, vs):
+                bindings[n] = v
+            return body(new_env)
+        return code
+
+    def compile_apply(self, exp, scopes, tail):
+        """
+        Compile a call to an unshadowed primitive into a direct call,
+        or return None if the call is not one.
+        """
+        fun = exp._fun
+        if type(fun) is not Symbol or any(fun._symbol in names for (names, _) in scopes):
+            return None
+        env = self.resolve(fun._symbol)
+        if env is None:
+            return None
+        f = env._bindings[fun._symbol]
+        n = len(exp._args)
+        if type(f) is not VPrimitive or f._tail is not None or n < f._min or (f._max is not None and n > f._max):
+            return None
+        args = [ self.compile(arg, scopes, False) for arg in exp._args ]
+        call = f._positional
+        if call and n == f._min:
+            if n == 1:
+                (a,) = args
+                code = lambda env: call(a(env))
+            elif n == 2:
+                (a, b) = args
+                code = lambda env: call(a(env), b(env))
+            else:
+                code = lambda env: call(*[ arg(env) for arg in args ])
+        else:
+            (prim, name) = (f._primitive, f._name)
+            if n == 2:
+                (a, b) = args
+                code = lambda env: prim(name, [a(env), b(env)]) or VNil()
+            else:
+                code = lambda env: prim(name, [ arg(env) for arg in args ]) or VNil()
+        if tail:
+            return lambda env: (code(env), None)
+        return code
+
+    def compile_call(self, exp, scopes, tail):
+        fun = self.compile(exp._fun, scopes, False)
+        args = [ self.compile(arg, scopes, False) for arg in exp._args ]
+        if tail:
+            return lambda env: _apply_partial(fun(env), [ arg(env) for arg in args ])
+        return lambda env: fun(env).apply([ arg(env) for arg in args ])
+
+
 
 
 # PARSER COMBINATORS
@@ -651,13 +1795,18 @@ class Reader:
 
     def __init__(self):
         self._macros = {}
+        # version given to each macro, and number of registrations so far
+        self._versions = {}
+        self._version = 0
         self._hook = lambda s: None
 
-    def register_macro(self, name, transform):
+    def register_macro(self, name, transform, version=0):
         name = name.lower()
         if name in self._macros:
             raise LispError('Macro {} already exists'.format(name))
         self._macros[name] = transform
+        self._versions[name] = version
+        self._version += 1
 
     def hook(self, fn):
         """
@@ -769,13 +1918,18 @@ class Reader:
 class Parser:
     def __init__(self):
         self._macros = {}
+        # version given to each macro, and number of registrations so far
+        self._versions = {}
+        self._version = 0
         self._gensym_count = 0
 
-    def register_macro(self, name, transform):
+    def register_macro(self, name, transform, version=0):
         name = name.lower()
         if name in self._macros:
             raise LispError('Macro {} already exists'.format(name))
         self._macros[name] = transform
+        self._versions[name] = version
+        self._version += 1
 
     def gensym(self, prefix='gsym'):
         c = self._gensym_count
@@ -789,6 +1943,12 @@ class Parser:
         result = self.parse_defun(sexp)
         if result:
             return('defun', result)
+        result = self.parse_defmemo(sexp)
+        if result:
+            return('defmemo', result)
+        result = self.parse_import(sexp)
+        if result:
+            return('import', result)
         result = self.parse_exp(sexp)
         if result:
             return('exp', result)
@@ -1034,16 +2194,111 @@ class Parser:
         return p(s)
 
 
+    def parse_defmemo(self, s):
+        p = self.parse_list([self.parse_keyword('defmemo'),
+                              self.parse_list([self.parse_identifier],
+                                              tail=self.parse_rep(self.parse_identifier))],
+                             tail=self.parse_exps)
+        p = parse_wrap(p, lambda x:(x[0][1][0][0], x[0][1][1], Do(x[1])))
+        return p(s)
+
+
+    def parse_import(self, s):
+        p = self.parse_list([self.parse_keyword('import'),
+                             lambda s: s.value() if s.is_string() else None])
+        p = parse_wrap(p, lambda x: x[1])
+        return p(s)
+
+
 _PRIMITIVES = []
 
 def check_arg_type(name, v, pred):
     if not pred(v):
         raise LispWrongArgTypeError('Wrong argument type {} to primitive {}'.format(v, name))
 
-def primitive(name, min, max=None):
+def check_arg_tag(name, v, tag):
+    """
+    Like check_arg_type, but against a mask of type tags,
+    which avoids building a predicate for every argument.
+    """
+    if not (v._tag or v.type_tag()) & tag:
+        raise LispWrongArgTypeError('Wrong argument type {} to primitive {}'.format(v, name))
+
+def check_arg_int(name, v):
+    """
+    Check that v is an integer number (floats can come from Python values),
+    and return its value.
+    """
+    check_arg_tag(name, v, TAG_NUMBER)
+    n = v.value()
+    if not isinstance(n, int) or isinstance(n, bool):
+        raise LispWrongArgTypeError('Wrong argument type {} to primitive {}: not an integer'.format(v, name))
+    return n
+
+def _arg_predicate(spec):
+    """
+    Turn a declared argument type into a predicate on values.
+    A type is a mask of type tags, a kind() string, a predicate,
+    or None to accept any value.
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        return lambda v: v.kind() == spec
+    if isinstance(spec, int):
+        return lambda v: (v._tag or v.type_tag()) & spec
+    return spec
+
+def _positional_wrapper(name, func, types):
+    """
+    Build, once, the function that checks declared argument types
+    and calls a positional primitive.
+    """
+    preds = [ _arg_predicate(t) for t in types ]
+    checks = [ (i, pred) for (i, pred) in enumerate(preds) if pred is not None ]
+
+    def wrong_type(v):
+        return LispWrongArgTypeError('Wrong argument type {} to primitive {}'.format(v, name))
+
+    if not checks:
+        def wrapper(*args):
+            return func(*args) or VNil()
+    elif len(preds) == 1:
+        pred = preds[0]
+        def wrapper(a):
+            if not pred(a):
+                raise wrong_type(a)
+            return func(a) or VNil()
+    elif len(preds) == 2 and len(checks) == 2:
+        (pred_a, pred_b) = preds
+        def wrapper(a, b):
+            if not pred_a(a):
+                raise wrong_type(a)
+            if not pred_b(b):
+                raise wrong_type(b)
+            return func(a, b) or VNil()
+    else:
+        def wrapper(*args):
+            for (i, pred) in checks:
+                if not pred(args[i]):
+                    raise wrong_type(args[i])
+            return func(*args) or VNil()
+    return wrapper
+
+def primitive(name, min, max=None, types=None, tail=None):
+    """
+    Register a primitive.
+    Normally the function is called with the primitive name and the
+    list of arguments. If types is given, one per argument, the
+    primitive has fixed arity and the function is called with the
+    arguments as positional Python arguments, already type-checked.
+    If tail is given, calls from LISP code use it instead: it is called
+    like the function but returns a (function, arguments) pair,
+    which the evaluator then applies in tail position.
+    """
     name = canonical(name)
     def decorator(func):
-        _PRIMITIVES.append((name, VPrimitive(name, func, min, max)))
+        _PRIMITIVES.append((name, VPrimitive(name, func, min, max, types, tail)))
         return func
     return decorator
 
@@ -1053,29 +2308,44 @@ def prim_type(name, args):
     return VSymbol(args[0].kind())
 
 
+# The arithmetic and comparison primitives check for the common case
+# of two plain numbers first, before the general variadic loop.
+
 @primitive('+', 0)
 def prim_plus(name, args):
+    if len(args) == 2:
+        (a, b) = args
+        if a._tag == TAG_NUMBER and b._tag == TAG_NUMBER:
+            return VNumber(a._value + b._value)
     v = 0
     for arg in args:
-        check_arg_type(name, arg, lambda v:v.is_number())
+        check_arg_tag(name, arg, TAG_NUMBER)
         v += arg.value()
     return VNumber(v)
 
 @primitive('*', 0)
 def prim_times(name, args):
+    if len(args) == 2:
+        (a, b) = args
+        if a._tag == TAG_NUMBER and b._tag == TAG_NUMBER:
+            return VNumber(a._value * b._value)
     v = 1
     for arg in args:
-        check_arg_type(name, arg, lambda v:v.is_number())
+        check_arg_tag(name, arg, TAG_NUMBER)
         v *= arg.value()
     return VNumber(v)
 
 @primitive('-', 1)
 def prim_minus(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_number())
+    if len(args) == 2:
+        (a, b) = args
+        if a._tag == TAG_NUMBER and b._tag == TAG_NUMBER:
+            return VNumber(a._value - b._value)
+    check_arg_tag(name, args[0], TAG_NUMBER)
     v = args[0].value()
     if args[1:]:
         for arg in args[1:]:
-            check_arg_type(name, arg, lambda v:v.is_number())
+            check_arg_tag(name, arg, TAG_NUMBER)
             v -= arg.value()
         return VNumber(v)
     else:
@@ -1085,26 +2355,33 @@ def prim_minus(name, args):
 def prim_equalp(name, args):
     return VBoolean(args[0].is_equal(args[1]))
 
-def _num_predicate(arg1, arg2, sym, pred):
-    check_arg_type(sym, arg1, lambda v:v.is_number())
-    check_arg_type(sym, arg2, lambda v:v.is_number())
-    return VBoolean(pred(arg1.value(), arg2.value()))
+def _num_compare(name, args, op):
+    if len(args) == 2:
+        (a, b) = args
+        if a._tag == TAG_NUMBER and b._tag == TAG_NUMBER:
+            return _TRUE if op(a._value, b._value) else _FALSE
+    for arg in args:
+        check_arg_tag(name, arg, TAG_NUMBER)
+    for i in range(len(args) - 1):
+        if not op(args[i].value(), args[i + 1].value()):
+            return _FALSE
+    return _TRUE
 
-@primitive('<', 2, 2)
+@primitive('<', 2)
 def prim_numless(name, args):
-    return _num_predicate(args[0], args[1], name, lambda v1, v2: v1 < v2)
+    return _num_compare(name, args, operator.lt)
 
-@primitive('<=', 2, 2)
+@primitive('<=', 2)
 def prim_numlesseq(name, args):
-    return _num_predicate(args[0], args[1], name, lambda v1, v2: v1 <= v2)
+    return _num_compare(name, args, operator.le)
 
-@primitive('>', 2, 2)
+@primitive('>', 2)
 def prim_numgreater(name, args):
-    return _num_predicate(args[0], args[1], name, lambda v1, v2: v1 > v2)
+    return _num_compare(name, args, operator.gt)
 
-@primitive('>=', 2, 2)
+@primitive('>=', 2)
 def prim_numgreatereq(name, args):
-    return _num_predicate(args[0], args[1], name, lambda v1, v2: v1 >= v2)
+    return _num_compare(name, args, operator.ge)
 
 @primitive('not', 1, 1)
 def prim_not(name, args):
@@ -1112,97 +2389,144 @@ def prim_not(name, args):
 
 @primitive('string-append', 0)
 def prim_string_append(name, args):
-    v = ''
     for arg in args:
-        check_arg_type(name, arg, lambda v:v.is_string())
-        v += arg.value()
-    return VString(v)
+        check_arg_tag(name, arg, TAG_STRING)
+    return VString(''.join([ arg.value() for arg in args ]))
+
+@primitive('string-join', 1, 2)
+def prim_string_join(name, args):
+    if args[0].is_vector():
+        strings = args[0].value()
+    else:
+        check_arg_tag(name, args[0], TAG_ANY_LIST)
+        strings = args[0].to_list()
+    for v in strings:
+        check_arg_tag(name, v, TAG_STRING)
+    if len(args) > 1:
+        check_arg_tag(name, args[1], TAG_STRING)
+        sep = args[1].value()
+    else:
+        sep = ''
+    return VString(sep.join([ v.value() for v in strings ]))
 
 @primitive('string-length', 1, 1)
 def prim_string_length(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_string())
+    check_arg_tag(name, args[0], TAG_STRING)
     return VNumber(len(args[0].value()))
 
 @primitive('string-lower', 1, 1)
 def prim_string_lower(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_string())
+    check_arg_tag(name, args[0], TAG_STRING)
     return VString(args[0].value().lower())
 
 @primitive('string-upper', 1, 1)
 def prim_string_upper(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_string())
+    check_arg_tag(name, args[0], TAG_STRING)
     return VString(args[0].value().upper())
 
 @primitive('string-substring', 1, 3)
 def prim_string_substring(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_string())
+    check_arg_tag(name, args[0], TAG_STRING)
     if len(args) > 2:
-        check_arg_type(name, args[2], lambda v:v.is_number())
+        check_arg_tag(name, args[2], TAG_NUMBER)
         end = args[2].value()
     else:
         end = len(args[0].value())
     if len(args) > 1:
-        check_arg_type(name, args[1], lambda v:v.is_number())
+        check_arg_tag(name, args[1], TAG_NUMBER)
         start = args[1].value()
     else:
         start = 0
     return VString(args[0].value()[start:end])
 
-@primitive('apply', 2, 2)
+def _apply_tail(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
+    return (args[0], args[1].to_list())
+
+@primitive('apply', 2, 2, tail=_apply_tail)
 def prim_apply(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_function())
-    check_arg_type(name, args[1], lambda v:v.is_list())
-    return args[0].apply(args[1].to_list())
+    (f, values) = _apply_tail(name, args)
+    return f.apply(values)
     
+@primitive('memoize', 1, 2)
+def prim_memoize(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    max_size = None
+    if len(args) > 1:
+        check_arg_tag(name, args[1], TAG_NUMBER)
+        max_size = args[1].value()
+        if max_size < 1:
+            raise LispError('Cache size for {} must be positive'.format(name))
+    return VMemoized(name, args[0], max_size)
+
+@primitive('memo-stats', 1, 1)
+def prim_memo_stats(name, args):
+    check_arg_type(name, args[0], lambda v:isinstance(v, VMemoized))
+    return VDict([ (VSymbol(k), VNil() if v is None else VNumber(v)) for (k, v) in args[0].stats().items() ])
+
+@primitive('memo-clear!', 1, 1)
+def prim_memo_clear(name, args):
+    check_arg_type(name, args[0], lambda v:isinstance(v, VMemoized))
+    args[0].clear()
+    return VNil()
+
 @primitive('cons', 2, 2)
 def prim_cons(name, args):
-    check_arg_type(name, args[1], lambda v:v.is_list())
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
     return VCons(args[0], args[1])
 
 @primitive('append', 0)
 def prim_append(name, args):
-    v = VEmpty()
-    for arg in reversed(args):
-        check_arg_type(name, arg, lambda v:v.is_list())
+    for arg in args:
+        check_arg_tag(name, arg, TAG_ANY_LIST)
+    if not args:
+        return VEmpty()
+    builder = _ListBuilder()
+    for arg in args[:-1]:
         curr = arg
-        temp = []
-        while not curr.is_empty():
-            temp.append(curr.car())
+        while curr.is_cons():
+            builder.append(curr.car())
             curr = curr.cdr()
-        for t in reversed(temp):
-            v = VCons(t, v)
-    return v
+    # lists are immutable, so the last one can be shared
+    return builder.finish(args[-1])
 
 @primitive('reverse', 1, 1)
 def prim_reverse(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_list())
-    v = VEmpty()
+    check_arg_tag(name, args[0], TAG_ANY_LIST)
+    v = _EMPTY
     curr = args[0]
-    while not curr.is_empty():
-        v = VCons(curr.car(), v)
+    while curr.is_cons():
+        if _active_meters:
+            _allocate('cons_cells', 1)
+        cell = VCons.__new__(VCons)
+        cell._car = curr.car()
+        cell._cdr = v
+        v = cell
         curr = curr.cdr()
     return v
 
 @primitive('first', 1, 1)
 def prim_first(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_cons())
+    check_arg_tag(name, args[0], TAG_CONS | TAG_LAZY | TAG_PYOBJECT)
     return args[0].car()
 
 @primitive('rest', 1, 1)
 def prim_rest(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_cons())
+    check_arg_tag(name, args[0], TAG_CONS | TAG_LAZY | TAG_PYOBJECT)
     return args[0].cdr()
 
 @primitive('list', 0)
 def prim_list(name, args):
-    v = VEmpty()
-    for arg in reversed(args):
-        v = VCons(arg, v)
-    return v
+    builder = _ListBuilder()
+    builder.extend(args)
+    return builder.finish()
 
 @primitive('length', 1, 1)
 def prim_length(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_list())
+    if args[0].is_pyobject():
+        return VNumber(args[0].length())
+    check_arg_tag(name, args[0], TAG_ANY_LIST)
     count = 0
     curr = args[0]
     while not curr.is_empty():
@@ -1212,9 +2536,10 @@ def prim_length(name, args):
 
 @primitive('nth', 2, 2)
 def prim_nth(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_list())
-    check_arg_type('nth', args[1], lambda v:v.is_number())
-    idx = args[1].value()
+    check_arg_tag(name, args[0], TAG_ANY_LIST | TAG_PYOBJECT)
+    idx = check_arg_int(name, args[1])
+    if args[0].is_pyobject():
+        return args[0].ref(idx)
     curr = args[0]
     while not curr.is_empty():
         if idx:
@@ -1226,62 +2551,348 @@ def prim_nth(name, args):
 
 @primitive('map', 2)
 def prim_map(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_function())
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    if all(arg.is_vector() for arg in args[1:]):
+        return VVector([ args[0].apply(list(firsts)) for firsts in zip(*[ arg.value() for arg in args[1:] ]) ])
+    if any(arg.is_lazy() or arg.is_pyobject() for arg in args[1:]):
+        iters = [ _seq_items(name, arg) for arg in args[1:] ]
+        return _build_list(args[0].apply(list(firsts)) for firsts in zip(*iters))
     for arg in args[1:]:
-        check_arg_type(name, arg, lambda v:v.is_list())
-    temp = []
+        check_arg_tag(name, arg, TAG_ANY_LIST)
+    f = args[0]
+    builder = _ListBuilder()
+    if len(args) == 2:
+        curr = args[1]
+        while curr.is_cons():
+            builder.append(f.apply([curr.car()]))
+            curr = curr.cdr()
+        return builder.finish()
     currs = args[1:]
     while all(curr.is_cons() for curr in currs):
         firsts = [ curr.car() for curr in currs ]
         currs = [ curr.cdr() for curr in currs ]
-        temp.append(args[0].apply(firsts))
-    v = VEmpty()
-    for t in reversed(temp):
-        v = VCons(t, v)
-    return v
+        builder.append(f.apply(firsts))
+    return builder.finish()
 
 @primitive('filter', 2, 2)
 def prim_filter(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_function())
-    check_arg_type(name, args[1], lambda v:v.is_list())
-    temp = []
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    if args[1].is_vector():
+        return VVector([ v for v in args[1].value() if args[0].apply([v]).is_true() ])
+    if args[1].is_lazy() or args[1].is_pyobject():
+        return _build_list(v for v in args[1].items() if args[0].apply([v]).is_true())
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
+    builder = _ListBuilder()
     curr = args[1]
-    while not curr.is_empty():
+    while curr.is_cons():
         if args[0].apply([curr.car()]).is_true():
-            temp.append(curr.car())
+            builder.append(curr.car())
         curr = curr.cdr()
-    v = VEmpty()
-    for t in reversed(temp):
-        v = VCons(t, v)
-    return v
+    return builder.finish()
 
 @primitive('foldr', 3, 3)
 def prim_foldr(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_function())
-    check_arg_type(name, args[1], lambda v:v.is_list())
-    curr = args[1]
-    temp = []
-    while not curr.is_empty():
-        temp.append(curr.car())
-        curr = curr.cdr()
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
     v = args[2]
-    for t in reversed(temp):
+    for t in reversed(args[1].to_list()):
         v = args[0].apply([t, v])
     return v
 
 @primitive('foldl', 3, 3)
 def prim_foldl(name, args):
-    check_arg_type(name, args[0], lambda v:v.is_function())
-    check_arg_type(name, args[2], lambda v:v.is_list())
-    curr = args[2]
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
     v = args[1]
+    if args[2].is_vector() or args[2].is_lazy() or args[2].is_pyobject():
+        for t in _seq_items(name, args[2]):
+            v = args[0].apply([v, t])
+        return v
+    check_arg_tag(name, args[2], TAG_ANY_LIST)
+    curr = args[2]
     while not curr.is_empty():
         v = args[0].apply([v, curr.car()])
         curr = curr.cdr()
     return v
 
+@primitive('vector', 0)
+def prim_vector(name, args):
+    return VVector(list(args))
+
+@primitive('vector-ref', 2, 2)
+def prim_vector_ref(name, args):
+    check_arg_tag(name, args[0], TAG_VECTOR)
+    return args[0].ref(check_arg_int(name, args[1]))
+
+@primitive('vector-set!', 3, 3)
+def prim_vector_set(name, args):
+    check_arg_tag(name, args[0], TAG_VECTOR)
+    args[0].set(check_arg_int(name, args[1]), args[2])
+    return VNil()
+
+@primitive('vector-length', 1, 1)
+def prim_vector_length(name, args):
+    check_arg_tag(name, args[0], TAG_VECTOR)
+    return VNumber(args[0].length())
+
+@primitive('vector->list', 1, 1)
+def prim_vector_to_list(name, args):
+    check_arg_tag(name, args[0], TAG_VECTOR)
+    return Value.from_tree(args[0].value())
+
+@primitive('list->vector', 1, 1)
+def prim_list_to_vector(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_LIST)
+    return VVector(args[0].to_list())
+
+def _seq_items(name, v):
+    """
+    Iterate over the elements of a list, vector, lazy sequence, or Python object.
+    """
+    if v.is_vector():
+        return iter(v.value())
+    if v.is_lazy() or v.is_pyobject():
+        return v.items()
+    check_arg_tag(name, v, TAG_ANY_LIST)
+    return v._cars() if v.is_cons() else iter(())
+
+def _lazy_map(f, iters):
+    for firsts in zip(*iters):
+        yield f.apply(list(firsts))
+
+def _lazy_filter(f, items):
+    for v in items:
+        if f.apply([v]).is_true():
+            yield v
+
+def _lazy_iterate(f, v):
+    while True:
+        yield v
+        v = f.apply([v])
+
+def _lazy_range(start, end, step):
+    i = start
+    while end is None or (i < end if step > 0 else i > end):
+        yield VNumber(i)
+        i += step
+
+@primitive('lazy-seq?', 1, 1)
+def prim_lazy_seqp(name, args):
+    return VBoolean(args[0].is_lazy())
+
+@primitive('lazy-map', 2)
+def prim_lazy_map(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    iters = [ _seq_items(name, arg) for arg in args[1:] ]
+    return VLazySeq(_lazy_map(args[0], iters))
+
+@primitive('lazy-filter', 2, 2)
+def prim_lazy_filter(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    return VLazySeq(_lazy_filter(args[0], _seq_items(name, args[1])))
+
+@primitive('iterate', 2, 2)
+def prim_iterate(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    return VLazySeq(_lazy_iterate(args[0], args[1]))
+
+@primitive('range', 0, 3)
+def prim_range(name, args):
+    for arg in args:
+        check_arg_tag(name, arg, TAG_NUMBER)
+    nums = [ arg.value() for arg in args ]
+    if not nums:
+        (start, end, step) = (0, None, 1)
+    elif len(nums) == 1:
+        (start, end, step) = (0, nums[0], 1)
+    else:
+        (start, end, step) = (nums[0], nums[1], nums[2] if len(nums) > 2 else 1)
+    if step == 0:
+        raise LispError('Step of range cannot be 0')
+    return VLazySeq(_lazy_range(start, end, step))
+
+@primitive('take', 2, 2)
+def prim_take(name, args):
+    n = max(check_arg_int(name, args[0]), 0)
+    if args[1].is_lazy():
+        return VLazySeq(itertools.islice(args[1].items(), n))
+    if args[1].is_vector():
+        return VVector(args[1].value()[:n])
+    return _build_list(itertools.islice(_seq_items(name, args[1]), n))
+
+@primitive('drop', 2, 2)
+def prim_drop(name, args):
+    n = max(check_arg_int(name, args[0]), 0)
+    if args[1].is_lazy():
+        return VLazySeq(itertools.islice(args[1].items(), n, None))
+    if args[1].is_vector():
+        return VVector(args[1].value()[n:])
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
+    curr = args[1]
+    while n and curr.is_cons():
+        curr = curr.cdr()
+        n -= 1
+    return curr
+
+@primitive('realize', 1, 1)
+def prim_realize(name, args):
+    if args[0].is_list():
+        return args[0]
+    return _build_list(_seq_items(name, args[0]))
+
+@primitive('py-object?', 1, 1)
+def prim_pyobjectp(name, args):
+    return VBoolean(args[0].is_pyobject())
+
+@primitive('py-get', 2)
+def prim_py_get(name, args):
+    v = args[0]
+    for key in args[1:]:
+        check_arg_tag(name, v, TAG_PYOBJECT)
+        v = v.get(key.to_python())
+    return v
+
+@primitive('py-len', 1, 1)
+def prim_py_len(name, args):
+    check_arg_tag(name, args[0], TAG_PYOBJECT)
+    return VNumber(args[0].length())
+
+@primitive('py-iter', 1, 1)
+def prim_py_iter(name, args):
+    check_arg_tag(name, args[0], TAG_PYOBJECT)
+    return VLazySeq(args[0].items())
+
+@primitive('py-call', 1)
+def prim_py_call(name, args):
+    check_arg_tag(name, args[0], TAG_PYOBJECT)
+    f = args[0].value()
+    if not callable(f):
+        raise LispWrongArgTypeError('Wrong argument type {} to primitive {}'.format(args[0], name))
+    try:
+        result = f(*[ arg.to_python() for arg in args[1:] ])
+    except Exception as e:
+        raise LispError('Python call failed: {}: {}'.format(type(e).__name__, e))
+    return VPyObject.wrap(result)
+
+def _seq_like(orig, values):
+    """
+    Package a Python list of values as a vector if orig is a vector,
+    and as a list otherwise.
+    """
+    return VVector(values) if orig.is_vector() else Value.from_tree(values)
+
+class _LispLess:
+    """
+    Sort key comparing with a LISP less-than function.
+    Python's sort only uses <, so each comparison is one call.
+    """
+    __slots__ = ('key', 'less')
+
+    def __init__(self, key, less):
+        self.key = key
+        self.less = less
+
+    def __lt__(self, other):
+        return self.less.apply([self.key, other.key]).is_true()
+
+@primitive('sort', 1, 3)
+def prim_sort(name, args):
+    values = list(_seq_items(name, args[0]))
+    # nil as comparison function sorts by a key in natural order
+    less = args[1] if len(args) > 1 and not args[1].is_nil() else None
+    if less is not None:
+        check_arg_tag(name, less, TAG_ANY_FUNCTION)
+    if len(args) > 2:
+        check_arg_tag(name, args[2], TAG_ANY_FUNCTION)
+        # one call to the key function per element
+        keys = [ args[2].apply([v]) for v in values ]
+    else:
+        keys = values
+    tags = set([ k.type_tag() for k in keys ])
+    if less is None:
+        # natural order on numbers or on strings
+        if len(tags) > 1 or not tags <= set([TAG_NUMBER, TAG_STRING]):
+            raise LispWrongArgTypeError('Cannot sort {} without a comparison function'.format(args[0]))
+        reverse = False
+    elif isinstance(less, VPrimitive) and less.value() in (prim_numless, prim_numgreater) and tags <= set([TAG_NUMBER]):
+        # the numeric comparisons need no calls back into LISP
+        reverse = less.value() is prim_numgreater
+    else:
+        order = sorted(range(len(values)), key=lambda i: _LispLess(keys[i], less))
+        return _seq_like(args[0], [ values[i] for i in order ])
+    order = sorted(range(len(values)), key=lambda i: keys[i].value(), reverse=reverse)
+    return _seq_like(args[0], [ values[i] for i in order ])
+
+@primitive('member', 2, 2)
+def prim_member(name, args):
+    x = args[0]
+    if args[1].is_lazy():
+        curr = args[1]
+        while not curr.is_exhausted():
+            if x.is_equal(curr.car()):
+                return curr
+            curr = curr.cdr()
+        return _FALSE
+    if args[1].is_vector():
+        values = args[1].value()
+        for (i, v) in enumerate(values):
+            if x.is_equal(v):
+                return VVector(values[i:])
+        return _FALSE
+    check_arg_tag(name, args[1], TAG_ANY_LIST)
+    curr = args[1]
+    while curr.is_cons():
+        if x.is_equal(curr.car()):
+            return curr
+        curr = curr.cdr()
+    return _FALSE
+
+@primitive('assoc', 2, 2)
+def prim_assoc(name, args):
+    x = args[0]
+    for entry in _seq_items(name, args[1]):
+        check_arg_tag(name, entry, TAG_CONS)
+        if x.is_equal(entry.car()):
+            return entry
+    return _FALSE
+
+@primitive('index-of', 2, 2)
+def prim_index_of(name, args):
+    x = args[0]
+    for (i, v) in enumerate(_seq_items(name, args[1])):
+        if x.is_equal(v):
+            return VNumber(i)
+    return _FALSE
+
+@primitive('last', 1, 1)
+def prim_last(name, args):
+    if args[0].is_vector():
+        values = args[0].value()
+    else:
+        values = collections.deque(_seq_items(name, args[0]), maxlen=1)
+    if not values:
+        raise LispError('Cannot take last of an empty sequence')
+    return values[-1]
+
+@primitive('count', 2, 2)
+def prim_count(name, args):
+    check_arg_tag(name, args[0], TAG_ANY_FUNCTION)
+    count = 0
+    for v in _seq_items(name, args[1]):
+        if args[0].apply([v]).is_true():
+            count += 1
+    return VNumber(count)
+
+@primitive('zip', 1)
+def prim_zip(name, args):
+    tuples = ( _build_list(t) for t in zip(*[ _seq_items(name, arg) for arg in args ]) )
+    if all(arg.is_vector() for arg in args):
+        return VVector(list(tuples))
+    return _build_list(tuples)
+
 @primitive('empty?', 1, 1)
 def prim_emptyp(name, args):
+    if args[0].is_lazy() or args[0].is_pyobject():
+        return VBoolean(args[0].is_exhausted())
     return VBoolean(args[0].is_empty())
     
 @primitive('cons?', 1, 1)
@@ -1308,6 +2919,10 @@ def prim_stringp(name, args):
 def prim_symbolp(name, args):
     return VBoolean(args[0].is_symbol())
 
+@primitive('vector?', 1, 1)
+def prim_vectorp(name, args):
+    return VBoolean(args[0].is_vector())
+
 @primitive('function?', 1, 1)
 def prim_functionp(name, args):
     return VBoolean(args[0].is_function())
@@ -1426,6 +3041,10 @@ def macro_or(parser, name, exps):
     return result
 
 
+def reader_vector(reader, name, exps):
+    return VCons(VSymbol('vector'), exps)
+
+
 #
 # Sample extension: references
 #
@@ -1438,7 +3057,10 @@ class VReference(Value):
         return 'VReference({})'.format(self._value)
 
     def __str__(self):
-        return '#(ref {})'.format(self._value)
+        return self.to_string()
+
+    def write_layout(self):
+        return ('#(ref ', [self._value], ')')
 
     def kind(self):
         return 'reference'
@@ -1479,63 +3101,89 @@ def reader_ref(reader, name, exps):
 # Sample extension: dictionaries
 #
 
+def _python_key(obj):
+    """
+    Make a converted dictionary key hashable: lists become tuples, dicts frozensets.
+    """
+    if isinstance(obj, list):
+        return tuple(_python_key(x) for x in obj)
+    if isinstance(obj, dict):
+        return frozenset((k, _python_key(v)) for (k, v) in obj.items())
+    return obj
+
 class VDict(Value):
     def __init__(self, entries):
-        self._value = entries
+        # hash key -> (key, value), in insertion order
+        self._entries = {}
+        for (k, v) in entries:
+            self.set(k, v)
 
     def __repr__(self):
-        return 'VDict({})'.format(self._value)
+        return 'VDict({})'.format(self.value())
 
     def __str__(self):
-        entries = ['({})'.format(' '.join([ str(x) for x in v])) for v in self._value]
-        return '#(dict {})'.format(' '.join(entries))
+        return self.to_string()
+
+    def write_layout(self):
+        return ('#(dict ', [ ('(', entry, ')') for entry in self._entries.values() ], ')')
 
-    def pp(self, prefix=0, suffix='', skip_prefix=False):
-        result = ''
-        if not skip_prefix:
-            result += ' ' * prefix
-        result += '#(dict '
-        # we could sort, but we don't have a sort order on arbitrary Value...
-        for i,(k, v) in enumerate(self._value):
-            skip =(i == 0)
-            last =(i == len(self._value) - 1)
-            sub_suffix = ')))' + suffix if last else ')\n'
-            result += '(' if skip else(' ' *(prefix + 7)) + '('
-            if k.is_string() or k.is_symbol() or k.is_number() or k.is_boolean():
-                key_text = k.pp(prefix=prefix + 8, skip_prefix=True, suffix=' ')
-                result += key_text
-                result += v.pp(prefix=prefix + 8 + len(key_text), skip_prefix=True, suffix=sub_suffix)
-            else:
-                result += k.pp(prefix=prefix + 8, skip_prefix=True, suffix='\n')
-                result += v.pp(prefix=prefix + 8, suffix=sub_suffix)
-        return result
-        
     def kind(self):
         return 'dictionary'
 
     def value(self):
-        return self._value
+        return list(self._entries.values())
+
+    def to_python(self):
+        return { _python_key(k.to_python()): v.to_python() for (k, v) in self._entries.values() }
 
     def is_equal(self, v):
-        # TODO: fix this comparison!
-        return v.is_dict() and self.value().is_equal(v.value())
+        if v.kind() != 'dictionary' or v.size() != self.size():
+            return False
+        for (key, value) in self._entries.values():
+            if not v.has(key) or not value.is_equal(v.lookup(key)):
+                return False
+        return True
+
+    def _key(self, k):
+        key = k.hash_key()
+        if key is None:
+            raise LispError('Cannot use {} as a dictionary key'.format(k))
+        return key
+
+    def lookup(self, k):
+        entry = self._entries.get(self._key(k))
+        if entry is None:
+            raise LispError('Cannot find key {} in dictionary'.format(k))
+        return entry[1]
 
-    def lookup(self, v):
-        for(key, value) in self._value:
-            if key.is_equal(v):
-                return value
-        raise LispError('Cannot find key {} in dictionary'.format(v))
+    def has(self, k):
+        return self._key(k) in self._entries
 
     def set(self, k, v):
-        for(i,(key, value)) in enumerate(self._value):
-            if key.is_equal(k):
-                self._value[i] = (key, v)
-        else:
-            self._value.append((k,v))
+        key = self._key(k)
+        entry = self._entries.get(key)
+        if entry is None and _active_meters:
+            _allocate('dict_entries', 1)
+        # keep the original key value when updating
+        self._entries[key] = (entry[0] if entry else k, v)
         return VNil()
 
+    def remove(self, k):
+        """
+        Remove a key from the dictionary, if present.
+        """
+        self._entries.pop(self._key(k), None)
+        return VNil()
+
+    def size(self):
+        return len(self._entries)
+
     def keys(self):
-        return [key for (key, value ) in self._value]
+        return [key for (key, value) in self._entries.values()]
+
+def _check_dict_key(name, v):
+    if v.hash_key() is None:
+        raise LispWrongArgTypeError('Wrong argument type {} to primitive {}'.format(v, name))
 
 def prim_dictp(name, args):
     return VBoolean(args[0].kind() == 'dictionary')
@@ -1545,22 +3193,374 @@ def prim_dict(name, args):
     for entry in entries:
         if len(entry) != 2:
             raise LispError('Wrong number of element in entry {}'.format(entry))
+        _check_dict_key(name, entry[0])
     return VDict(entries)
 
 def prim_dict_get(name, args):
     check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
-    check_arg_type(name, args[1], lambda v:v.is_atom())
+    _check_dict_key(name, args[1])
     return args[0].lookup(args[1])
 
 def prim_dict_set(name, args):
     check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
-    check_arg_type(name, args[1], lambda v:v.is_atom())
+    _check_dict_key(name, args[1])
     return args[0].set(args[1], args[2])
 
+def prim_dict_remove(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
+    _check_dict_key(name, args[1])
+    return args[0].remove(args[1])
+
+def prim_dict_has(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
+    _check_dict_key(name, args[1])
+    return VBoolean(args[0].has(args[1]))
+
+def prim_dict_size(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
+    return VNumber(args[0].size())
+
 def prim_dict_keys(name, args):
     check_arg_type(name, args[0], lambda v:v.kind() == 'dictionary')
     return Value.from_tree(args[0].keys())
 
+#
+# Sample extension: persistent maps
+#
+# A hash array mapped trie: each node consumes 5 bits of the key
+# hash, and stores its children in a compact list indexed by the
+# population count of a 32-bit bitmap. Updates copy only the path
+# from the root to the changed leaf, so old maps stay valid and
+# share all other nodes with the new map.
+#
+# A leaf is a tuple (hash, key, k, v) where key is the hash_key()
+# of the Value k.
+#
+
+_HAMT_BITS = 5
+_HAMT_MASK = (1 << _HAMT_BITS) - 1
+
+def _popcount(n):
+    return bin(n).count('1')
+
+
+class _HamtNode:
+    __slots__ = ('bitmap', 'items')
+
+    def __init__(self, bitmap, items):
+        self.bitmap = bitmap
+        self.items = items
+
+    def find(self, shift, h, key):
+        bit = 1 << ((h >> shift) & _HAMT_MASK)
+        if not self.bitmap & bit:
+            return None
+        item = self.items[_popcount(self.bitmap & (bit - 1))]
+        if type(item) is tuple:
+            return item if item[1] == key else None
+        return item.find(shift + _HAMT_BITS, h, key)
+
+    def assoc(self, shift, leaf):
+        """
+        Return (new node, True if a new key was added)
+        """
+        bit = 1 << ((leaf[0] >> shift) & _HAMT_MASK)
+        idx = _popcount(self.bitmap & (bit - 1))
+        if not self.bitmap & bit:
+            return (_HamtNode(self.bitmap | bit, self.items[:idx] + [leaf] + self.items[idx:]), True)
+        item = self.items[idx]
+        if type(item) is not tuple:
+            (new, added) = item.assoc(shift + _HAMT_BITS, leaf)
+        elif item[1] == leaf[1]:
+            (new, added) = (leaf, False)
+        else:
+            (new, added) = (_hamt_merge(shift + _HAMT_BITS, item, leaf), True)
+        items = list(self.items)
+        items[idx] = new
+        return (_HamtNode(self.bitmap, items), added)
+
+    def dissoc(self, shift, h, key):
+        """
+        Return the new node, None if the node is now empty,
+        or the node itself if the key is not present
+        """
+        bit = 1 << ((h >> shift) & _HAMT_MASK)
+        if not self.bitmap & bit:
+            return self
+        idx = _popcount(self.bitmap & (bit - 1))
+        item = self.items[idx]
+        if type(item) is tuple:
+            if item[1] != key:
+                return self
+            new = None
+        else:
+            new = item.dissoc(shift + _HAMT_BITS, h, key)
+            if new is item:
+                return self
+            if new is not None and len(new.items) == 1 and type(new.items[0]) is tuple:
+                # pull a lone leaf up into this node
+                new = new.items[0]
+        if new is None:
+            if self.bitmap == bit:
+                return None
+            return _HamtNode(self.bitmap ^ bit, self.items[:idx] + self.items[idx + 1:])
+        items = list(self.items)
+        items[idx] = new
+        return _HamtNode(self.bitmap, items)
+
+    def leaves(self):
+        for item in self.items:
+            if type(item) is tuple:
+                yield item
+            else:
+                yield from item.leaves()
+
+
+class _HamtCollision:
+    # leaves whose keys have the same full hash
+    __slots__ = ('hash', 'items')
+
+    def __init__(self, h, items):
+        self.hash = h
+        self.items = items
+
+    def find(self, shift, h, key):
+        for leaf in self.items:
+            if leaf[1] == key:
+                return leaf
+        return None
+
+    def assoc(self, shift, leaf):
+        for (i, item) in enumerate(self.items):
+            if item[1] == leaf[1]:
+                items = list(self.items)
+                items[i] = leaf
+                return (_HamtCollision(self.hash, items), False)
+        if leaf[0] != self.hash:
+            # the hashes only differ deeper down: split into a node
+            return (_hamt_merge(shift, self, leaf), True)
+        return (_HamtCollision(self.hash, self.items + [leaf]), True)
+
+    def dissoc(self, shift, h, key):
+        items = [ leaf for leaf in self.items if leaf[1] != key ]
+        if len(items) == len(self.items):
+            return self
+        return _HamtCollision(self.hash, items) if items else None
+
+    def leaves(self):
+        return iter(self.items)
+
+
+def _hamt_merge(shift, leaf1, leaf2):
+    # leaf1 may also be a collision node, whose hash differs from leaf2's
+    h1 = leaf1[0] if type(leaf1) is tuple else leaf1.hash
+    if h1 == leaf2[0]:
+        return _HamtCollision(h1, [leaf1, leaf2])
+    frag1 = (h1 >> shift) & _HAMT_MASK
+    frag2 = (leaf2[0] >> shift) & _HAMT_MASK
+    if frag1 == frag2:
+        return _HamtNode(1 << frag1, [_hamt_merge(shift + _HAMT_BITS, leaf1, leaf2)])
+    items = [leaf1, leaf2] if frag1 < frag2 else [leaf2, leaf1]
+    return _HamtNode((1 << frag1) | (1 << frag2), items)
+
+
+_HAMT_EMPTY = _HamtNode(0, [])
+
+
+class VPMap(Value):
+    def __init__(self, root=_HAMT_EMPTY, size=0):
+        self._root = root
+        self._size = size
+
+    def __repr__(self):
+        return 'VPMap({})'.format(self.value())
+
+    def __str__(self):
+        return self.to_string()
+
+    def write_layout(self):
+        return ('#(pmap ', [ ('(', entry, ')') for entry in self.value() ], ')')
+
+    def kind(self):
+        return 'pmap'
+
+    def value(self):
+        return [ (k, v) for (_, _, k, v) in self._root.leaves() ]
+
+    def to_python(self):
+        return { _python_key(k.to_python()): v.to_python() for (k, v) in self.value() }
+
+    def is_equal(self, v):
+        if v.kind() != 'pmap' or v.size() != self.size():
+            return False
+        for (_, key, k, value) in self._root.leaves():
+            if not v.has(k) or not value.is_equal(v.lookup(k)):
+                return False
+        return True
+
+    def hash_key(self):
+        keys = []
+        for (_, key, _, value) in self._root.leaves():
+            value_key = value.hash_key()
+            if value_key is None:
+                return None
+            keys.append((key, value_key))
+        return ('pmap', frozenset(keys))
+
+    def _key(self, k):
+        key = k.hash_key()
+        if key is None:
+            raise LispError('Cannot use {} as a map key'.format(k))
+        return (hash(key) & 0xFFFFFFFF, key)
+
+    def lookup(self, k):
+        (h, key) = self._key(k)
+        leaf = self._root.find(0, h, key)
+        if leaf is None:
+            raise LispError('Cannot find key {} in map'.format(k))
+        return leaf[3]
+
+    def has(self, k):
+        (h, key) = self._key(k)
+        return self._root.find(0, h, key) is not None
+
+    def assoc(self, k, v):
+        (h, key) = self._key(k)
+        (root, added) = self._root.assoc(0, (h, key, k, v))
+        if added and _active_meters:
+            _allocate('dict_entries', 1)
+        return VPMap(root, self._size + 1 if added else self._size)
+
+    def dissoc(self, k):
+        (h, key) = self._key(k)
+        root = self._root.dissoc(0, h, key)
+        if root is self._root:
+            return self
+        return VPMap(root or _HAMT_EMPTY, self._size - 1)
+
+    def size(self):
+        return self._size
+
+    def keys(self):
+        return [ k for (_, _, k, _) in self._root.leaves() ]
+
+def prim_pmapp(name, args):
+    return VBoolean(args[0].kind() == 'pmap')
+
+def prim_pmap(name, args):
+    result = VPMap()
+    for arg in args:
+        entry = arg.to_list()
+        if len(entry) != 2:
+            raise LispError('Wrong number of element in entry {}'.format(arg))
+        _check_dict_key(name, entry[0])
+        result = result.assoc(entry[0], entry[1])
+    return result
+
+def prim_pmap_get(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    _check_dict_key(name, args[1])
+    return args[0].lookup(args[1])
+
+def prim_pmap_has(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    _check_dict_key(name, args[1])
+    return VBoolean(args[0].has(args[1]))
+
+def prim_pmap_assoc(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    _check_dict_key(name, args[1])
+    return args[0].assoc(args[1], args[2])
+
+def prim_pmap_dissoc(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    _check_dict_key(name, args[1])
+    return args[0].dissoc(args[1])
+
+def prim_pmap_size(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    return VNumber(args[0].size())
+
+def prim_pmap_keys(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'pmap')
+    return Value.from_tree(args[0].keys())
+
+def reader_pmap(reader, name, exps):
+    entries = []
+    for entry in exps.to_list():
+        items = entry.to_list(error=False)
+        if items is None or len(items) != 2:
+            raise LispReadError('Cannot read `{}`: entry {} not a key-value pair'.format(name, entry))
+        entries.append([VSymbol('list')] + items)
+    return Value.from_tree([VSymbol('pmap')] + entries)
+
+#
+# Sample extension: string builders
+#
+
+class VStringBuilder(Value):
+    def __init__(self):
+        self._chunks = []
+
+    def __repr__(self):
+        return 'VStringBuilder({})'.format(len(self._chunks))
+
+    def __str__(self):
+        h = id(self)
+        return '#[string-builder {}]'.format(hex(h))
+
+    def kind(self):
+        return 'string-builder'
+
+    def value(self):
+        if len(self._chunks) > 1:
+            # collapse so that repeated conversions do not rejoin
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def to_python(self):
+        return self.value()
+
+    def append(self, s):
+        if _active_meters:
+            _allocate('string_chars', len(s))
+        self._chunks.append(s)
+
+def prim_string_builderp(name, args):
+    return VBoolean(args[0].kind() == 'string-builder')
+
+def prim_string_builder(name, args):
+    sb = VStringBuilder()
+    for arg in args:
+        check_arg_tag(name, arg, TAG_STRING)
+        sb.append(arg.value())
+    return sb
+
+def prim_sb_append(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'string-builder')
+    for arg in args[1:]:
+        check_arg_tag(name, arg, TAG_STRING)
+    for arg in args[1:]:
+        args[0].append(arg.value())
+    return VNil()
+
+def prim_sb_append_all(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'string-builder')
+    if args[1].is_vector():
+        strings = args[1].value()
+    else:
+        check_arg_tag(name, args[1], TAG_ANY_LIST)
+        strings = args[1].to_list()
+    for v in strings:
+        check_arg_tag(name, v, TAG_STRING)
+    for v in strings:
+        args[0].append(v.value())
+    return VNil()
+
+def prim_sb_to_string(name, args):
+    check_arg_type(name, args[0], lambda v:v.kind() == 'string-builder')
+    return VString(args[0].value())
+
 # def flag_hook(s):
 #     """
 #     Sample flag hook for the Reader.
@@ -1572,14 +3572,239 @@ def prim_dict_keys(name, args):
 #         return(VCons(VSymbol('quote'), VCons(VSymbol(m.group()), VEmpty())), ss[m.end():])
 #     return None
 
+class InputState:
+    """
+    Incremental scanner splitting lines of input into complete s-expressions.
+    Only the new input is scanned on every call to feed(), keeping track
+    of the parenthesis depth, of strings and escapes, and of partial tokens,
+    so a long form pasted line by line is scanned once.
+    """
+    _DELIMITERS = frozenset(' \t\r\n()"\'')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # text of the incomplete form from previous lines
+        self._parts = []
+        self._depth = 0
+        self._state = 'normal'
+
+    def pending(self):
+        """
+        True if the input so far ends inside an incomplete form.
+        """
+        return bool(self._parts)
+
+    def feed(self, line):
+        """
+        Consume a line of input, and return the list of forms it completes.
+        """
+        forms = []
+        delimiters = self._DELIMITERS
+        state = self._state
+        depth = self._depth
+        # start of the current form in this line, and of the current token at depth 0
+        start = 0 if self._parts else None
+        token = None
+        pos = 0
+        size = len(line)
+        while pos < size:
+            c = line[pos]
+            end = None
+            if state == 'string':
+                if c == '"':
+                    state = 'normal'
+                    if depth == 0:
+                        end = pos + 1
+                elif c == '\\':
+                    state = 'escape'
+            elif state == 'escape':
+                state = 'string'
+            elif token is not None:
+                if c == '(' and token == pos - 1 and line[token] == '#':
+                    # reader macro opening with #(
+                    depth = 1
+                    token = None
+                elif c in delimiters:
+                    end = pos
+                    token = None
+                    pos -= 1   # the delimiter may start the next form
+            elif c in ' \t\r\n':
+                pass
+            else:
+                if start is None:
+                    start = pos
+                if c == '(':
+                    depth += 1
+                elif c == ')':
+                    depth -= 1
+                    if depth <= 0:
+                        depth = 0
+                        end = pos + 1
+                elif c == '"':
+                    state = 'string'
+                elif depth == 0 and c != "'":
+                    token = pos
+            pos += 1
+            if end is not None:
+                forms.append(''.join(self._parts) + line[start:end])
+                self._parts = []
+                start = None
+        if token is not None:
+            # the end of a line also ends a token
+            forms.append(''.join(self._parts) + line[start:])
+            self._parts = []
+        elif start is not None:
+            self._parts.append(line[start:] + '\n')
+        self._state = state
+        self._depth = depth
+        return forms
+
+    def flush(self):
+        """
+        Return the text of the incomplete form, if any, and reset the scanner.
+        """
+        text = ''.join(self._parts)
+        self.reset()
+        return text
+
+# the outcome of evaluating one top-level form of a script:
+# value is None when error is set, and times are in seconds
+FormResult = collections.namedtuple('FormResult', ['source', 'value', 'error', 'read_time', 'parse_time', 'eval_time'])
+
+class ScriptResult:
+    """
+    The outcome of Engine.eval_script(), with one FormResult per top-level form.
+    """
+    def __init__(self):
+        self.forms = []
+
+    def values(self):
+        return [ f.value for f in self.forms if f.error is None ]
+
+    def errors(self):
+        return [ f.error for f in self.forms if f.error is not None ]
+
+    def ok(self):
+        return all(f.error is None for f in self.forms)
+
+    def value(self):
+        """
+        The value of the last form, or nil if it failed or there are no forms.
+        """
+        if self.forms and self.forms[-1].error is None:
+            return self.forms[-1].value
+        return VNil()
+
+    def read_time(self):
+        return sum(f.read_time for f in self.forms)
+
+    def parse_time(self):
+        return sum(f.parse_time for f in self.forms)
+
+    def eval_time(self):
+        return sum(f.eval_time for f in self.forms)
+
+    def slowest(self, n=10):
+        """
+        The n forms that took the longest to evaluate.
+        """
+        return sorted(self.forms, key=lambda f: f.eval_time, reverse=True)[:n]
+
+class PreparedScript:
+    """
+    A script read and parsed once by Engine.prepare(), run by calling it with
+    values for its parameters. Every call binds the parameters in a fresh
+    environment on top of the engine's, so calls do not see each other's
+    definitions.
+    """
+    def __init__(self, engine, forms, params):
+        self._engine = engine
+        self._forms = forms
+        self._params = params
+        # a script made of a single expression is evaluated directly
+        (kind, result) = forms[-1] if forms else ('exp', None)
+        self._exp = result if len(forms) == 1 and kind == 'exp' else None
+
+    def params(self):
+        return list(self._params)
+
+    def run(self, values):
+        """
+        Run the script with a list of Values for the parameters, and return a Value.
+        """
+        if len(values) != len(self._params):
+            raise LispWrongArgNoError('Wrong number of arguments to prepared script: expected {}, got {}'.format(len(self._params), len(values)))
+        env = Environment(bindings=zip(self._params, values), previous=self._engine._env)
+        with self._engine._budget(None):
+            if self._exp is not None:
+                return self._exp.eval(env)
+            v = VNil()
+            for parsed in self._forms:
+                v = self._engine._eval_parsed(parsed, env)
+            return v
+
+    def __call__(self, *args, **kwargs):
+        """
+        Run the script with Python values for the parameters, given by position
+        or by name, and return the result as a Python value.
+        """
+        values = [ Value.from_python(arg) for arg in args ]
+        for p in self._params[len(values):]:
+            if p not in kwargs:
+                raise LispWrongArgNoError('Missing argument {} to prepared script'.format(p))
+            values.append(Value.from_python(kwargs.pop(p)))
+        if kwargs:
+            raise LispWrongArgNoError('Unknown arguments {} to prepared script'.format(', '.join(kwargs)))
+        return self.run(values).to_python()
+
+# directory, next to a module, holding its parsed forms
+_MODULE_CACHE_DIR = '__mlispcache__'
+# bump when the layout of the cached forms changes
+_MODULE_CACHE_FORMAT = 1
+
+def _trusted_cache(f):
+    """
+    Unpickling a cache file runs code chosen by whoever wrote it, so only
+    trust files owned by the current user and writable by no one else.
+    """
+    if not hasattr(os, 'getuid'):
+        return True
+    st = os.fstat(f.fileno())
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+# longest input line accepted by the REPL server, in bytes
+_LINE_LIMIT = 1 << 20
+
 class Engine:
-    def __init__(self, prompt='>'):
+    def __init__(self, prompt='>', print_max_length=None, print_max_depth=None, memo_max_size=1024,
+                 max_steps=None, max_cons_cells=None, max_string_chars=None, max_dict_entries=None):
         self._default_prompt = prompt
+        # default budget of every evaluation (None for no limit)
+        self._limits = {
+            'steps': max_steps,
+            'cons_cells': max_cons_cells,
+            'string_chars': max_string_chars,
+            'dict_entries': max_dict_entries
+        }
+        # cache size of functions defined with defmemo
+        self._memo_max_size = memo_max_size
+        # limits used when printing values
+        self._print_max_length = print_max_length
+        self._print_max_depth = print_max_depth
         # reader/parser have state
         self._parser = Parser()
         self._reader = Reader()
         # basic environment
         self._env = Environment(bindings=_PRIMITIVES)
+        # imported modules by path, and directories of the modules being loaded
+        self._modules = {}
+        self._module_dirs = []
+        # per-thread state, for sessions of the REPL server
+        self._local = threading.local()
+        # tasks shutting down the thread pool of each server once it closes
+        self._server_tasks = set()
         ##self._reader.hook(flag_hook)
         self.def_value('true', VBoolean(True))
         self.def_value('false', VBoolean(False))
@@ -1592,6 +3817,8 @@ class Engine:
         self.register_macro('and', macro_and)
         self.register_macro('or', macro_or)
         self.register_macro('loop', macro_loop)
+        # vectors
+        self.register_reader('vector', reader_vector)
         # references
         self.def_primitive('ref?', prim_refp, 1, 1)
         self.def_primitive('ref', prim_ref, 1, 1)
@@ -1604,6 +3831,27 @@ class Engine:
         self.def_primitive('dict-get', prim_dict_get, 2, 2)
         self.def_primitive('dict-set!', prim_dict_set, 3, 3)
         self.def_primitive('dict-keys', prim_dict_keys, 1, 1)
+        self.def_primitive('dict-remove!', prim_dict_remove, 2, 2)
+        self.def_primitive('dict-has?', prim_dict_has, 2, 2)
+        self.def_primitive('dict-size', prim_dict_size, 1, 1)
+        # persistent maps
+        self.def_primitive('pmap?', prim_pmapp, 1, 1)
+        self.def_primitive('pmap', prim_pmap, 0, None)
+        self.def_primitive('pmap-get', prim_pmap_get, 2, 2)
+        self.def_primitive('pmap-has?', prim_pmap_has, 2, 2)
+        self.def_primitive('pmap-assoc', prim_pmap_assoc, 3, 3)
+        self.def_primitive('pmap-dissoc', prim_pmap_dissoc, 2, 2)
+        self.def_primitive('pmap-size', prim_pmap_size, 1, 1)
+        self.def_primitive('pmap-keys', prim_pmap_keys, 1, 1)
+        self.register_reader('pmap', reader_pmap)
+        # string builders
+        self.def_primitive('string-builder?', prim_string_builderp, 1, 1)
+        self.def_primitive('string-builder', prim_string_builder, 0, None)
+        self.def_primitive('sb-append!', prim_sb_append, 1, None)
+        self.def_primitive('sb-append-all!', prim_sb_append_all, 2, 2)
+        self.def_primitive('sb->string', prim_sb_to_string, 1, 1)
+        # modules are evaluated on top of the initial environment
+        self._global_env = self._env
 
     def prompt(self):
         return self._default_prompt
@@ -1621,18 +3869,63 @@ class Engine:
     def def_value(self, name, value):
         self._env.add(name, value)
 
-    def def_primitive(self, name, prim, min, max):
-        self._env.add(name, VPrimitive(name, prim, min, max))
+    def bind_iterable(self, name, iterable, convert=None, cache=True):
+        """
+        Bind name to a lazy sequence over a Python iterable.
+        Elements are pulled from the iterable and converted (using
+        Value.from_python by default) only when the script reaches them.
+        Realized elements are cached by the sequence, so they stay
+        in memory for as long as the binding refers to its head.
+        With cache=False, the sequence is one-pass instead: traversals
+        consume the iterable without keeping the elements they read.
+        """
+        convert = convert or Value.from_python
+        seq = (VLazySeq if cache else VOnePassSeq)(map(convert, iter(iterable)))
+        self.def_value(name, seq)
+        return seq
+
+    def get(self, name):
+        """
+        Look up a binding in the current environment, converted to a Python value.
+        """
+        return self._env.lookup(name).to_python()
 
-    def register_macro(self, name, macro):
-        self.parser().register_macro(name, macro)
+    def call(self, name, *args, fuel=None):
+        """
+        Apply the function bound to name to Python arguments, converted with
+        Value.from_python, and return the result converted back to Python.
+        """
+        f = self._env.lookup(name)
+        values = [ Value.from_python(arg) for arg in args ]
+        with self._budget(fuel):
+            return f.apply(values).to_python()
+
+    def def_primitive(self, name, prim, min, max, types=None, tail=None):
+        self._env.add(name, VPrimitive(name, prim, min, max, types, tail))
+
+    def register_macro(self, name, macro, version=0):
+        """
+        Register a parser macro. Modules are cached already macro-expanded,
+        so bump version whenever the behavior of the macro changes.
+        """
+        self.parser().register_macro(name, macro, version)
 
-    def register_reader(self, name, macro):
-        self.reader().register_macro(name, macro)
+    def register_reader(self, name, macro, version=0):
+        """
+        Register a reader macro, with a version as for register_macro.
+        """
+        self.reader().register_macro(name, macro, version)
 
     def prim_print(self, name, args):
-        result = ' '.join([arg.display() for arg in args])
-        self.emit(result)
+        stream = io.StringIO()
+        for (i, arg) in enumerate(args):
+            if i:
+                stream.write(' ')
+            if arg.write_layout() is None:
+                stream.write(arg.display())
+            else:
+                arg.write(stream, self._print_max_length, self._print_max_depth)
+        self.emit(stream.getvalue())
 
     def read(self, s):
         if not s.strip():
@@ -1642,67 +3935,266 @@ class Engine:
             return result[0]
         raise LispReadError('Cannot read {}'.format(s))
         
-    def eval(self, sexp, report=False):
-        (kind, result) = self.parser().parse(sexp)
+    def read_all(self, s):
+        """
+        Read every s-expression in a string, in order.
+        """
+        sexps = []
+        for (source, sexp, error) in self._read_forms(s):
+            if error is not None:
+                raise error
+            sexps.append(sexp)
+        return sexps
+
+    def _read_forms(self, s):
+        """
+        Yield (source, s-expression, None) for every top-level form of a
+        string, and stop after yielding (source, None, error) for a form that
+        cannot be read. The string is first split into the text of each form,
+        since the reader copies the text left after every token it reads.
+        """
+        state = InputState()
+        texts = state.feed(s)
+        texts.append(state.flush())
+        reader = self.reader()
+        for text in texts:
+            rest = text
+            while rest.strip():
+                try:
+                    with _unmetered():
+                        result = reader.parse_sexp(rest)
+                    if not result:
+                        raise LispReadError('Cannot read {}'.format(rest.strip()))
+                except LispError as e:
+                    yield (rest.strip(), None, e)
+                    return
+                (sexp, after) = result
+                yield (rest[:len(rest) - len(after)].strip(), sexp, None)
+                rest = after
+
+    def eval_script(self, script, env=None, stop_on_error=False, fuel=None):
+        """
+        Read and evaluate every top-level form of a script, given as a string,
+        a file object or a path, and return a ScriptResult.
+        A form failing with a LispError is recorded and evaluation moves on to
+        the next form, unless stop_on_error is set. A read error stops the script,
+        and so does running out of the budget of fuel steps for the whole script.
+        """
+        with self._budget(fuel):
+            return self._eval_script(script, env, stop_on_error)
+
+    def _eval_script(self, script, env, stop_on_error):
+        if hasattr(script, 'read'):
+            script = script.read()
+        elif isinstance(script, os.PathLike):
+            with open(script) as f:
+                script = f.read()
+        env = env or self._env
+        parser = self.parser()
+        clock = time.perf_counter
+        result = ScriptResult()
+        forms = self._read_forms(script)
+        while True:
+            start = clock()
+            (source, sexp, error) = next(forms, (None, None, None))
+            if source is None:
+                break
+            if error is not None:
+                result.forms.append(FormResult(source, None, error, clock() - start, 0.0, 0.0))
+                break
+            read_end = clock()
+            parse_end = None
+            value = error = None
+            try:
+                with _unmetered():
+                    parsed = parser.parse(sexp)
+                parse_end = clock()
+                value = self._eval_parsed(parsed, env)
+            except LispError as e:
+                error = e
+            end = clock()
+            if parse_end is None:
+                # the form failed to parse
+                parse_end = end
+            result.forms.append(FormResult(source, value, error, read_end - start, parse_end - read_end, end - parse_end))
+            if error is not None and (stop_on_error or isinstance(error, LispResourceError)):
+                break
+        return result
+
+    def eval_many(self, scripts, env=None, stop_on_error=False, fuel=None):
+        """
+        Evaluate several scripts in turn with eval_script(), and return their results.
+        """
+        return [ self.eval_script(script, env, stop_on_error, fuel) for script in scripts ]
+
+    def prepare(self, source, params=[]):
+        """
+        Read and parse every form of source once, and return a PreparedScript
+        that evaluates them with the given parameters bound.
+        """
+        params = [ canonical(p) for p in params ]
+        forms = [ self.parser().parse(sexp) for sexp in self.read_all(source) ]
+        return PreparedScript(self, forms, params)
+
+    def eval(self, sexp, report=False, env=None, fuel=None):
+        """
+        Evaluate an s-expression. With a budget of fuel steps (by default
+        the engine's max_steps), raise LispResourceError if evaluation
+        takes more evaluation steps and function applications than that,
+        or if it creates more cons cells, string characters or dictionary
+        entries than the engine's quotas allow.
+        """
+        parsed = self.parser().parse(sexp)
+        with self._budget(fuel):
+            return self._eval_parsed(parsed, env or self._env, report)
+
+    def _budget(self, fuel):
+        limits = dict(self._limits)
+        if fuel is not None:
+            limits['steps'] = fuel
+        if all(limit is None for limit in limits.values()):
+            return contextlib.nullcontext()
+        return _metered(**limits)
+
+    def _eval_parsed(self, parsed, env, report=False):
+        (kind, result) = parsed
         if kind == 'define':
             (name, expr) = result
             name = canonical(name)
-            v = expr.eval(self._env)
-            self._env.add(name, v)
+            v = expr.eval(env)
+            env.add(name, v)
             if report:
                 self._emit_report(name)
             return VNil()
         if kind == 'defun':
             (name, params, expr) = result
             params = [ canonical(p) for p in params ]
-            v = VFunction(params, expr, self._env)
-            self._env.add(name, v)
+            v = VFunction(params, expr, env)
+            env.add(name, v)
             if report:
                 self._emit_report(name)
             return VNil()
+        if kind == 'defmemo':
+            (name, params, expr) = result
+            params = [ canonical(p) for p in params ]
+            v = VMemoized(name, VFunction(params, expr, env), self._memo_max_size)
+            env.add(name, v)
+            if report:
+                self._emit_report(name)
+            return VNil()
+        if kind == 'import':
+            self.import_module(result, env)
+            return VNil()
         if kind == 'exp':
-            return result.eval(self._env)
+            return result.eval(env)
         raise LispError('Cannot recognize top level kind {}'.format(kind))
 
+    # MODULES
+
+    def macro_version(self):
+        """
+        A fingerprint of the reader and parser macros registered in the engine:
+        their names, the functions implementing them, and their versions.
+        Cached module forms are only reused by engines with the same fingerprint,
+        since the forms are stored already macro-expanded.
+        """
+        h = hashlib.sha256(str(_MODULE_CACHE_FORMAT).encode())
+        for table in (self.reader(), self.parser()):
+            h.update('{};'.format(table._version).encode())
+            for name in sorted(table._macros):
+                f = table._macros[name]
+                h.update('{}={}.{}@{};'.format(name, getattr(f, '__module__', None),
+                                               getattr(f, '__qualname__', type(f).__qualname__),
+                                               table._versions[name]).encode())
+            h.update(b'|')
+        return h.hexdigest()
+
+    def import_module(self, path, env=None):
+        """
+        Add the definitions of the module at path to env (the current
+        environment by default). A module is evaluated only once per engine
+        in its own environment, so every import shares the same bindings.
+        Relative paths are resolved against the importing module's directory.
+        """
+        env = env or self._env
+        if not os.path.isabs(path) and self._module_dirs:
+            path = os.path.join(self._module_dirs[-1], path)
+        path = os.path.realpath(path)
+        if path not in self._modules:
+            self._modules[path] = None
+            try:
+                self._modules[path] = self._load_module(path)
+            except BaseException:
+                del self._modules[path]
+                raise
+        module_env = self._modules[path]
+        if module_env is None:
+            raise LispError('Circular import of module {}'.format(path))
+        for (name, value) in module_env._bindings.items():
+            env.add(name, value)
+        return module_env
+
+    def _load_module(self, path):
+        try:
+            with open(path, 'rb') as f:
+                source = f.read()
+        except OSError as e:
+            raise LispError('Cannot import module {}: {}'.format(path, e.strerror))
+        with _unmetered():
+            forms = self._module_forms(path, source)
+        module_env = Environment(previous=self._global_env)
+        self._module_dirs.append(os.path.dirname(path))
+        try:
+            for parsed in forms:
+                self._eval_parsed(parsed, module_env)
+        finally:
+            self._module_dirs.pop()
+        return module_env
+
+    def _module_forms(self, path, source):
+        """
+        Return the parsed (and macro-expanded) top-level forms of a module,
+        from the on-disk cache if it was written for the same source and macros.
+        """
+        key = hashlib.sha256(source).hexdigest() + ':' + self.macro_version()
+        (directory, filename) = os.path.split(path)
+        cache_path = os.path.join(directory, _MODULE_CACHE_DIR, filename + '.pickle')
+        try:
+            with open(cache_path, 'rb') as f:
+                if _trusted_cache(f):
+                    (cached_key, forms) = pickle.load(f)
+                    if cached_key == key:
+                        return forms
+        except Exception:
+            # missing, unreadable or stale cache: parse the source again
+            pass
+        text = source.decode('utf-8')
+        forms = [ self.parser().parse(sexp) for sexp in self.read_all(text) ]
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((key, forms), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            # caching is best effort (read-only directory, unpicklable macro output)
+            pass
+        return forms
+
     def balance(self, str):
-        state = 'normal'
-        count = 0
-        pos = 0
-        while pos < len(str):
-            if state == 'normal':
-                if str[pos] == '(':
-                    pos += 1
-                    count += 1
-                elif str[pos] == ')':
-                    pos += 1
-                    count -= 1
-                elif str[pos] == '"':
-                    pos += 1
-                    state = 'string'
-                else:
-                    pos += 1
-            elif state == 'string':
-                if str[pos] == '"':
-                    pos += 1
-                    state = 'normal'
-                elif str[pos] == '\\':
-                    pos += 1
-                    state = 'escape'
-                elif str[pos] == '\n':
-                    raise LispParseError('Unterminated string')
-                else:
-                    pos += 1
-            elif state == 'escape':
-                pos += 1
-                state = 'string'
-        # this will ignore inputs past the end of the first expression
-        return count <= 0
-                    
-    def process_line(self, full_input):
+        """
+        Check whether a string holds no incomplete s-expression.
+        Inputs past the end of the first expression are accepted.
+        """
+        state = InputState()
+        state.feed(str)
+        return not state.pending()
+
+    def process_line(self, full_input, env=None):
         try:
             sexp = self.read(full_input)
             if sexp:
-                v = self.eval(sexp, report=True)
+                v = self.eval(sexp, report=True, env=env)
                 self.emit_value(v)
             else:
                 self.emit_value(VNil())   #??
@@ -1712,7 +4204,12 @@ class Engine:
     def emit(self, s):
         """
         Generic print a string to standard output.
+        In a session of the REPL server, the string goes to the session instead.
         """
+        output = getattr(self._local, 'output', None)
+        if output is not None:
+            output.append(s)
+            return
         print(s)
 
     def _emit_report(self, msg):
@@ -1731,7 +4228,7 @@ class Engine:
         Override if standard output treats values specially (i.e., as a result).
         """
         if not v.is_nil():
-            self.emit(str(v))
+            self.emit(v.to_string(self._print_max_length, self._print_max_depth))
 
     def repl(self, on_error=None):
         """
@@ -1739,28 +4236,163 @@ class Engine:
         running on the current engine
         """
         self.new_env()   # working environment
+        state = InputState()
         done = False
         while not done:
             try:
                 # to deal with win_unicode_console flushing problem
-                full_input = ''
                 pr = self.prompt()
-                while True:
-                    print(pr + ' ', end='')
-                    sys.stdout.flush()
-                    s = input()  #.decode(_DEFAULT_ENCODING)
-                    full_input += s + ' '
-                    if self.balance(full_input):
-                        break
-                    pr = '.' * len(pr)   # use continuation prompt after first iteration
-                self.process_line(full_input)
+                if state.pending():
+                    pr = '.' * len(pr)   # use continuation prompt inside a form
+                print(pr + ' ', end='')
+                sys.stdout.flush()
+                s = input()  #.decode(_DEFAULT_ENCODING)
+                for form in state.feed(s):
+                    self.process_line(form)
             except EOFError:
                 done = True
             except LispQuit:
                 done = True
             except Exception as e: 
                 print(traceback.format_exc())
-    
+                state.reset()
+
+    # SERVER
+
+    def serve(self, host='127.0.0.1', port=0, max_workers=4, line_limit=_LINE_LIMIT):
+        """
+        Accept REPL sessions on a TCP port until interrupted.
+        """
+        asyncio.run(self._serve_forever(self.start_server(host, port, max_workers, line_limit)))
+
+    def serve_unix(self, path, max_workers=4, line_limit=_LINE_LIMIT):
+        """
+        Accept REPL sessions on a Unix socket until interrupted.
+        """
+        asyncio.run(self._serve_forever(self.start_unix_server(path, max_workers, line_limit)))
+
+    async def start_server(self, host='127.0.0.1', port=0, max_workers=4, line_limit=_LINE_LIMIT):
+        """
+        Start an asyncio server for REPL sessions on a TCP port, and return it.
+        Each session evaluates in its own environment on top of the current one,
+        in a pool of max_workers threads so a slow session does not block the others.
+        Input lines longer than line_limit bytes are rejected with an error.
+        The thread pool is shut down when the server is closed.
+        """
+        return await self._start_server(functools.partial(asyncio.start_server, host=host, port=port),
+                                        max_workers, line_limit)
+
+    async def start_unix_server(self, path, max_workers=4, line_limit=_LINE_LIMIT):
+        """
+        Like start_server, but on a Unix socket.
+        """
+        return await self._start_server(functools.partial(asyncio.start_unix_server, path=path),
+                                        max_workers, line_limit)
+
+    async def _start_server(self, start, max_workers, line_limit):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            server = await start(self._session_handler(executor, line_limit), limit=line_limit)
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        task = asyncio.ensure_future(_shutdown_when_closed(server, executor))
+        self._server_tasks.add(task)
+        task.add_done_callback(self._server_tasks.discard)
+        return server
+
+    async def _serve_forever(self, start):
+        server = await start
+        async with server:
+            await server.serve_forever()
+
+    def _session_handler(self, executor, line_limit):
+        async def handle(reader, writer):
+            loop = asyncio.get_running_loop()
+            env = Environment(previous=self._env)
+            state = InputState()
+            try:
+                while True:
+                    pr = self.prompt()
+                    if state.pending():
+                        pr = '.' * len(pr)
+                    writer.write((pr + ' ').encode('utf-8'))
+                    await writer.drain()
+                    line = await _read_line(reader)
+                    if line is None:
+                        # the line was skipped: drop the form it belongs to
+                        state.reset()
+                        writer.write(';; LispReadError: Input line longer than {} bytes\n'.format(line_limit).encode('utf-8'))
+                        continue
+                    if not line:
+                        break
+                    for form in state.feed(line.decode('utf-8', 'replace').rstrip('\r\n')):
+                        (output, done) = await loop.run_in_executor(executor, self._session_eval, form, env)
+                        writer.write(output.encode('utf-8'))
+                        if done:
+                            return
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except ConnectionError:
+                    pass
+        return handle
+
+    def _session_eval(self, form, env):
+        output = []
+        done = False
+        self._local.output = output
+        try:
+            self.process_line(form, env)
+        except LispQuit:
+            done = True
+        except Exception as e:
+            self.emit(';; {}: {}'.format(type(e).__name__, e))
+        finally:
+            self._local.output = None
+        return (''.join(s + '\n' for s in output), done)
+
+
+async def _read_line(reader):
+    """
+    Read a line from a stream, with its end of line. Return b'' at the end
+    of the stream, and None if the line is longer than the stream's limit,
+    after skipping it.
+    """
+    try:
+        return await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        # last line without an end of line
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        overrun = e
+    while True:
+        # drop what is buffered, and look for the end of the line again
+        await reader.readexactly(overrun.consumed)
+        try:
+            await reader.readuntil(b'\n')
+            return None
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError as e:
+            overrun = e
+
+async def _shutdown_when_closed(server, executor):
+    try:
+        await server.wait_closed()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def serve_unix(path, engine=None, max_workers=4, line_limit=_LINE_LIMIT):
+    """
+    Accept REPL sessions on a Unix socket, using a new engine by default.
+    """
+    (engine or Engine()).serve_unix(path, max_workers, line_limit)
+
 
 if __name__ == '__main__':
     Engine().repl()
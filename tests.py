@@ -1,4 +1,10 @@
 from unittest import TestCase
+import os
+import tempfile
+import asyncio
+import threading
+import pathlib
+import time
 
 import mlisp
 
@@ -466,6 +472,402 @@ class TestValueFunction(TestCase):
         self.assertEqual(result.value(), 42)
 
 
+class TestValueTags(TestCase):
+
+    def test_builtin_tags(self):
+        self.assertEqual(mlisp.VNumber(42).type_tag(), mlisp.TAG_NUMBER)
+        self.assertEqual(mlisp.VEmpty().type_tag(), mlisp.TAG_EMPTY)
+        self.assertEqual(mlisp.VCons(mlisp.VNumber(42), mlisp.VEmpty()).type_tag(), mlisp.TAG_CONS)
+        self.assertEqual(mlisp.VReference(mlisp.VNil()).type_tag(), 0)
+
+    def test_kind_only_subclass(self):
+        # a subclass that only overrides kind() still answers the predicates
+        class VMyList(mlisp.Value):
+            def kind(self):
+                return 'empty-list'
+        class VMyNumber(mlisp.VNumber):
+            def kind(self):
+                return 'other'
+        v = VMyList()
+        self.assertEqual(v.type_tag(), mlisp.TAG_EMPTY)
+        self.assertEqual(v.is_list(), True)
+        self.assertEqual(v.is_empty(), True)
+        self.assertEqual(v.is_atom(), False)
+        c = mlisp.VCons(mlisp.VNumber(42), v)
+        self.assertEqual(c.cdr(), v)
+        n = VMyNumber(42)
+        self.assertEqual(n.is_number(), False)
+        self.assertEqual(n.is_atom(), False)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_plus('+', [n])
+
+
+
+class TestValueVector(TestCase):
+
+    def test_vector(self):
+        b = mlisp.VVector([mlisp.VNumber(42), mlisp.VString('Alice')])
+        self.assertEqual(str(b), '#(vector 42 "Alice")')
+        self.assertEqual(str(mlisp.VVector([])), '#(vector)')
+        self.assertEqual(b.kind(), 'vector')
+        self.assertEqual(b.is_vector(), True)
+        self.assertEqual(b.is_list(), False)
+        self.assertEqual(b.is_atom(), False)
+        self.assertEqual(b.is_true(), True)
+        self.assertEqual(b.length(), 2)
+        self.assertEqual(b.ref(1).value(), 'Alice')
+        b.set(1, mlisp.VNumber(84))
+        self.assertEqual(b.ref(1).value(), 84)
+        self.assertEqual(b.is_equal(mlisp.VVector([mlisp.VNumber(42), mlisp.VNumber(84)])), True)
+        self.assertEqual(b.is_equal(mlisp.VVector([mlisp.VNumber(42)])), False)
+        self.assertEqual(b.is_equal(_make_list([mlisp.VNumber(42), mlisp.VNumber(84)])), False)
+        with self.assertRaises(mlisp.LispError):
+            b.ref(2)
+        with self.assertRaises(mlisp.LispError):
+            b.set(-1, mlisp.VNil())
+
+
+class TestValueHash(TestCase):
+
+    def test_hash_key(self):
+        self.assertEqual(mlisp.VNumber(42).hash_key(), mlisp.VNumber(42).hash_key())
+        self.assertNotEqual(mlisp.VNumber(1).hash_key(), mlisp.VBoolean(True).hash_key())
+        self.assertNotEqual(mlisp.VString('a').hash_key(), mlisp.VSymbol('a').hash_key())
+        self.assertEqual(mlisp.VSymbol('Alice').hash_key(), mlisp.VSymbol('alice').hash_key())
+        self.assertNotEqual(mlisp.VNil().hash_key(), mlisp.VEmpty().hash_key())
+        lst = _make_list([mlisp.VNumber(42), [mlisp.VString('Alice')]])
+        self.assertEqual(lst.hash_key(), _make_list([mlisp.VNumber(42), [mlisp.VString('Alice')]]).hash_key())
+        self.assertNotEqual(lst.hash_key(), _make_list([mlisp.VNumber(42)]).hash_key())
+        # mutable values cannot be hashed
+        self.assertEqual(mlisp.VVector([]).hash_key(), None)
+        self.assertEqual(mlisp.VReference(mlisp.VNumber(42)).hash_key(), None)
+        self.assertEqual(_make_list([mlisp.VVector([])]).hash_key(), None)
+
+
+class TestValueDict(TestCase):
+
+    def test_dict(self):
+        d = mlisp.VDict([(mlisp.VNumber(1), mlisp.VString('one')),
+                         (mlisp.VString('two'), mlisp.VNumber(2))])
+        self.assertEqual(str(d), '#(dict (1 "one") ("two" 2))')
+        self.assertEqual(d.kind(), 'dictionary')
+        self.assertEqual(d.size(), 2)
+        self.assertEqual(d.lookup(mlisp.VNumber(1)).value(), 'one')
+        self.assertEqual(d.has(mlisp.VString('two')), True)
+        self.assertEqual(d.has(mlisp.VSymbol('two')), False)
+        with self.assertRaises(mlisp.LispError):
+            d.lookup(mlisp.VNumber(2))
+        # updating keeps the position and does not duplicate
+        d.set(mlisp.VNumber(1), mlisp.VString('uno'))
+        self.assertEqual(d.size(), 2)
+        self.assertEqual(str(d), '#(dict (1 "uno") ("two" 2))')
+        d.set(_make_list([mlisp.VNumber(3)]), mlisp.VNumber(3))
+        self.assertEqual(d.lookup(_make_list([mlisp.VNumber(3)])).value(), 3)
+        d.remove(mlisp.VString('two'))
+        d.remove(mlisp.VString('two'))
+        self.assertEqual([k.value() for k in d.keys()][0], 1)
+        self.assertEqual(d.size(), 2)
+        with self.assertRaises(mlisp.LispError):
+            d.set(mlisp.VVector([]), mlisp.VNil())
+        self.assertEqual(d.is_equal(mlisp.VDict([(_make_list([mlisp.VNumber(3)]), mlisp.VNumber(3)),
+                                                 (mlisp.VNumber(1), mlisp.VString('uno'))])), True)
+        self.assertEqual(d.is_equal(mlisp.VDict([(mlisp.VNumber(1), mlisp.VString('uno'))])), False)
+        self.assertEqual(d.is_equal(mlisp.VNumber(1)), False)
+
+
+class TestValuePMap(TestCase):
+
+    def test_pmap(self):
+        m = mlisp.VPMap()
+        self.assertEqual(str(m), '#(pmap )')
+        self.assertEqual(m.kind(), 'pmap')
+        self.assertEqual(m.size(), 0)
+        m1 = m.assoc(mlisp.VNumber(1), mlisp.VString('one'))
+        m2 = m1.assoc(mlisp.VString('two'), mlisp.VNumber(2))
+        m3 = m2.assoc(mlisp.VNumber(1), mlisp.VString('uno'))
+        # older versions are unchanged
+        self.assertEqual(m.size(), 0)
+        self.assertEqual(m1.size(), 1)
+        self.assertEqual(m2.size(), 2)
+        self.assertEqual(m3.size(), 2)
+        self.assertEqual(m2.lookup(mlisp.VNumber(1)).value(), 'one')
+        self.assertEqual(m3.lookup(mlisp.VNumber(1)).value(), 'uno')
+        self.assertEqual(m1.has(mlisp.VString('two')), False)
+        self.assertEqual(m2.has(mlisp.VString('two')), True)
+        with self.assertRaises(mlisp.LispError):
+            m1.lookup(mlisp.VString('two'))
+        m4 = m3.dissoc(mlisp.VNumber(1))
+        self.assertEqual(m4.size(), 1)
+        self.assertEqual(m3.size(), 2)
+        self.assertEqual(m4.dissoc(mlisp.VNumber(1)), m4)
+        self.assertEqual(m2.is_equal(mlisp.VPMap().assoc(mlisp.VString('two'), mlisp.VNumber(2))
+                                                  .assoc(mlisp.VNumber(1), mlisp.VString('one'))), True)
+        self.assertEqual(m2.is_equal(m3), False)
+        self.assertEqual(m2.hash_key(), m2.dissoc(mlisp.VNumber(1)).assoc(mlisp.VNumber(1), mlisp.VString('one')).hash_key())
+
+    def test_pmap_many(self):
+        m = mlisp.VPMap()
+        versions = []
+        for i in range(2000):
+            m = m.assoc(mlisp.VNumber(i), mlisp.VNumber(i * i))
+            versions.append(m)
+        for i in range(0, 2000, 2):
+            m = m.dissoc(mlisp.VNumber(i))
+        self.assertEqual(m.size(), 1000)
+        self.assertEqual(versions[999].size(), 1000)
+        for i in range(2000):
+            self.assertEqual(m.has(mlisp.VNumber(i)), i % 2 == 1)
+            self.assertEqual(versions[-1].lookup(mlisp.VNumber(i)).value(), i * i)
+        self.assertEqual(versions[10].has(mlisp.VNumber(11)), False)
+
+    def test_pmap_collisions(self):
+        # force hashes: 1 and 33 share their lowest fragment only
+        hashes = {'a': 1, 'b': 1, 'c': 33, 'd': 1}
+        original = mlisp.VPMap._key
+        mlisp.VPMap._key = lambda self, k: (hashes[k.value()], k.hash_key())
+        try:
+            m = mlisp.VPMap()
+            for k in 'abcd':
+                m = m.assoc(mlisp.VString(k), mlisp.VString(k.upper()))
+            self.assertEqual(m.size(), 4)
+            for k in 'abcd':
+                self.assertEqual(m.lookup(mlisp.VString(k)).value(), k.upper())
+            # only keys with the same full hash share a collision node
+            def collisions(node):
+                if isinstance(node, mlisp._HamtCollision):
+                    yield node
+                elif isinstance(node, mlisp._HamtNode):
+                    for item in node.items:
+                        yield from collisions(item)
+            found = list(collisions(m._root))
+            self.assertEqual(len(found), 1)
+            self.assertEqual(sorted(leaf[2].value() for leaf in found[0].items), ['a', 'b', 'd'])
+            m = m.assoc(mlisp.VString('c'), mlisp.VString('C2'))
+            self.assertEqual(m.size(), 4)
+            self.assertEqual(m.lookup(mlisp.VString('c')).value(), 'C2')
+            m = m.dissoc(mlisp.VString('a')).dissoc(mlisp.VString('c'))
+            self.assertEqual(sorted(k.value() for k in m.keys()), ['b', 'd'])
+            self.assertEqual(m.has(mlisp.VString('c')), False)
+        finally:
+            mlisp.VPMap._key = original
+
+
+class TestValueWrite(TestCase):
+
+    def test_write(self):
+        import io
+        lst = _make_list([mlisp.VNumber(1), [mlisp.VNumber(2), [mlisp.VNumber(3)]], mlisp.VString('Alice'), mlisp.VNumber(4)])
+        stream = io.StringIO()
+        lst.write(stream)
+        self.assertEqual(stream.getvalue(), '(1 (2 (3)) "Alice" 4)')
+        self.assertEqual(str(lst), '(1 (2 (3)) "Alice" 4)')
+        self.assertEqual(lst.to_string(max_length=2), '(1 (2 (3)) ...)')
+        self.assertEqual(lst.to_string(max_length=0), '(...)')
+        self.assertEqual(lst.to_string(max_depth=2), '(1 (2 ...) "Alice" 4)')
+        self.assertEqual(lst.to_string(max_depth=0), '...')
+        self.assertEqual(mlisp.VNumber(42).to_string(max_depth=0), '42')
+        self.assertEqual(mlisp.VEmpty().to_string(), '()')
+
+    def test_write_long(self):
+        lst = mlisp.Value.from_tree([mlisp.VNumber(i) for i in range(50000)])
+        self.assertEqual(str(lst).startswith('(0 1 2 '), True)
+        self.assertEqual(lst.to_string(max_length=3), '(0 1 2 ...)')
+        nested = mlisp.VEmpty()
+        for i in range(5000):
+            nested = mlisp.VCons(nested, mlisp.VEmpty())
+        self.assertEqual(len(str(nested)), 10002)
+
+    def test_write_cycle(self):
+        r = mlisp.VReference(mlisp.VNil())
+        v = mlisp.VVector([mlisp.VNumber(1), r])
+        r.set_value(v)
+        self.assertEqual(str(r), '#(ref #(vector 1 ...))')
+        self.assertEqual(str(v), '#(vector 1 #(ref ...))')
+        # sharing without a cycle prints in full
+        shared = _make_list([mlisp.VNumber(42)])
+        self.assertEqual(str(mlisp.VVector([shared, shared])), '#(vector (42) (42))')
+
+
+class TestValuePrettyPrint(TestCase):
+
+    def test_pp_fits(self):
+        lst = _make_list([mlisp.VSymbol('list'), mlisp.VNumber(1), [mlisp.VNumber(2)]])
+        self.assertEqual(lst.pp(), '(list 1 (2))')
+        self.assertEqual(lst.pp(prefix=2, suffix='!'), '  (list 1 (2))!')
+        self.assertEqual(lst.pp(prefix=2, skip_prefix=True), '(list 1 (2))')
+        self.assertEqual(mlisp.VString('Alice').pp(prefix=1), ' "Alice"')
+
+    def test_pp_breaks(self):
+        lst = _make_list([mlisp.VSymbol('if'),
+                          [mlisp.VSymbol('='), mlisp.VSymbol('n'), mlisp.VNumber(0)],
+                          mlisp.VNumber(1),
+                          [mlisp.VSymbol('*'), mlisp.VSymbol('n'), mlisp.VNumber(42)]])
+        self.assertEqual(lst.pp(width=20), '(if\n (= n 0)\n 1\n (* n 42))')
+        # closing parentheses count against the width
+        self.assertEqual(lst.pp(width=30), '(if (= n 0) 1 (* n 42))')
+        self.assertEqual(lst.pp(width=22), '(if\n (= n 0)\n 1\n (* n 42))')
+        self.assertEqual(lst.pp(prefix=2, width=20), '  (if\n   (= n 0)\n   1\n   (* n 42))')
+
+    def test_pp_dict(self):
+        d = mlisp.VDict([(mlisp.VString('Alice'), _make_list([mlisp.VNumber(1), mlisp.VNumber(2)])),
+                         (mlisp.VNumber(42), mlisp.VBoolean(True))])
+        self.assertEqual(d.pp(), '#(dict ("Alice" (1 2)) (42 #true))')
+        self.assertEqual(d.pp(width=20), '#(dict ("Alice"\n        (1 2))\n       (42 #true))')
+
+    def test_pp_extension(self):
+        class VPair(mlisp.Value):
+            def kind(self):
+                return 'pair'
+            def write_layout(self):
+                return ('#(pair ', [mlisp.VNumber(1), mlisp.VNumber(2)], ')')
+        self.assertEqual(str(VPair().to_string()), '#(pair 1 2)')
+        self.assertEqual(VPair().pp(width=8), '#(pair 1\n       2)')
+
+    def test_pp_long(self):
+        lst = mlisp.Value.from_tree([mlisp.VNumber(i) for i in range(20000)])
+        self.assertEqual(len(lst.pp(width=10).split('\n')), 20000)
+
+
+class TestValueLazySeq(TestCase):
+
+    def test_lazy_seq(self):
+        pulled = []
+        def source():
+            for i in range(3):
+                pulled.append(i)
+                yield mlisp.VNumber(i)
+        s = mlisp.VLazySeq(source())
+        self.assertEqual(s.kind(), 'lazy-seq')
+        self.assertEqual(s.is_lazy(), True)
+        self.assertEqual(s.is_list(), False)
+        self.assertEqual(str(s).startswith('#[lazy-seq '), True)
+        self.assertEqual(pulled, [])
+        self.assertEqual(s.car().value(), 0)
+        self.assertEqual(pulled, [0])
+        # realized cells are cached
+        self.assertEqual(s.car().value(), 0)
+        self.assertEqual(s.cdr().car().value(), 1)
+        self.assertEqual(pulled, [0, 1])
+        self.assertEqual([v.value() for v in s.items()], [0, 1, 2])
+        self.assertEqual([v.value() for v in s.items()], [0, 1, 2])
+        self.assertEqual(pulled, [0, 1, 2])
+        end = s.cdr().cdr().cdr()
+        self.assertEqual(end.is_exhausted(), True)
+        with self.assertRaises(mlisp.LispError):
+            end.car()
+        with self.assertRaises(mlisp.LispError):
+            end.cdr()
+
+    def test_lazy_seq_error(self):
+        def source():
+            yield mlisp.VNumber(0)
+            raise mlisp.LispError('boom')
+        s = mlisp.VLazySeq(source())
+        self.assertEqual(s.car().value(), 0)
+        tail = s.cdr()
+        for _ in range(2):
+            with self.assertRaisesRegex(mlisp.LispError, 'boom'):
+                tail.is_exhausted()
+            with self.assertRaisesRegex(mlisp.LispError, 'boom'):
+                tail.car()
+        self.assertEqual(s.car().value(), 0)
+
+
+class TestValueFromPython(TestCase):
+
+    def test_from_python(self):
+        self.assertEqual(mlisp.Value.from_python(42).is_equal(mlisp.VNumber(42)), True)
+        self.assertEqual(mlisp.Value.from_python(True).is_equal(mlisp.VBoolean(True)), True)
+        self.assertEqual(mlisp.Value.from_python('Alice').is_equal(mlisp.VString('Alice')), True)
+        self.assertEqual(mlisp.Value.from_python(None).is_nil(), True)
+        self.assertEqual(mlisp.Value.from_python([]).is_empty(), True)
+        v = mlisp.Value.from_python([1, ('a', None)])
+        self.assertEqual(str(v), '(1 ("a" #nil))')
+        v = mlisp.Value.from_python({'a': [1, 2]})
+        self.assertEqual(v.kind(), 'dictionary')
+        self.assertEqual(str(v.lookup(mlisp.VString('a'))), '(1 2)')
+        n = mlisp.VNumber(42)
+        self.assertEqual(mlisp.Value.from_python(n), n)
+        with self.assertRaises(mlisp.LispError):
+            mlisp.Value.from_python(object())
+
+    def test_to_python(self):
+        for obj in [42, True, 'Alice', None, [], [1, ['a', None], 'b'], {'a': [1, 2], 'b': {'c': 3}}]:
+            self.assertEqual(mlisp.Value.from_python(obj).to_python(), obj)
+        self.assertEqual(mlisp.VSymbol('foo').to_python(), 'foo')
+        self.assertEqual(mlisp.VVector([mlisp.VNumber(1), mlisp.VEmpty()]).to_python(), [1, []])
+        v = mlisp.VDict([(mlisp.Value.from_python([1, 2]), mlisp.VNumber(3))])
+        self.assertEqual(v.to_python(), {(1, 2): 3})
+        # keys holding unhashable values are converted all the way down
+        inner = mlisp.VPMap().assoc(mlisp.VString('b'), mlisp.Value.from_python([2]))
+        key = mlisp.VPMap().assoc(mlisp.VString('a'), mlisp.Value.from_tree([mlisp.VNumber(1), inner]))
+        v = mlisp.VPMap().assoc(key, mlisp.VNumber(3))
+        self.assertEqual(v.to_python(), {frozenset([('a', (1, frozenset([('b', (2,))])))]): 3})
+        v = mlisp.VDict([(key, mlisp.VNumber(3))])
+        self.assertEqual(v.to_python(), {frozenset([('a', (1, frozenset([('b', (2,))])))]): 3})
+        f = mlisp.VPrimitive('f', lambda name, args: None, 0, 0)
+        self.assertIs(f.to_python(), f)
+
+
+class TestValuePyObject(TestCase):
+
+    def test_pyobject_wrap(self):
+        payload = {'a': [1, 2]}
+        v = mlisp.VPyObject(payload)
+        self.assertEqual(v.is_pyobject(), True)
+        self.assertEqual(v.kind(), 'py-object')
+        self.assertIs(v.value(), payload)
+        self.assertIs(v.to_python(), payload)
+        self.assertEqual(v.is_equal(mlisp.VPyObject(payload)), True)
+        self.assertEqual(v.is_equal(mlisp.VPyObject({'a': [1, 2]})), False)
+        self.assertEqual(mlisp.VPyObject.wrap(42).is_number(), True)
+        self.assertEqual(mlisp.VPyObject.wrap('a').is_string(), True)
+        self.assertEqual(mlisp.VPyObject.wrap(None).is_nil(), True)
+        # containers are not copied
+        self.assertIs(v.get('a').value(), payload['a'])
+        self.assertEqual(v.get('a').ref(1).value(), 2)
+        self.assertEqual(v.length(), 1)
+        self.assertEqual(v.car().value(), 'a')
+        with self.assertRaises(mlisp.LispError):
+            v.get('b')
+        with self.assertRaises(mlisp.LispError):
+            v.get('a').ref(2)
+
+
+class TestValuePrimitivePositional(TestCase):
+
+    def test_positional(self):
+        b = mlisp.VPrimitive('test', lambda x, y: mlisp.VNumber(x.value() - y.value()), 2, 2,
+                             types=[mlisp.TAG_NUMBER, mlisp.TAG_NUMBER])
+        self.assertEqual(b.apply([mlisp.VNumber(42), mlisp.VNumber(2)]).value(), 40)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            b.apply([mlisp.VNumber(42), mlisp.VString('Alice')])
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            b.apply([mlisp.VNumber(42)])
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            b.apply([mlisp.VNumber(42), mlisp.VNumber(42), mlisp.VNumber(42)])
+        # None result maps to nil
+        b = mlisp.VPrimitive('test', lambda x: None, 1, 1, types=[None])
+        self.assertEqual(b.apply([mlisp.VNumber(42)]).is_nil(), True)
+        # kind strings and predicates as types
+        b = mlisp.VPrimitive('test', lambda d, k, v: d.lookup(k), 3, 3,
+                             types=['dictionary', lambda v: v.is_atom(), None])
+        d = mlisp.VDict([(mlisp.VNumber(1), mlisp.VNumber(42))])
+        self.assertEqual(b.apply([d, mlisp.VNumber(1), mlisp.VNil()]).value(), 42)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            b.apply([mlisp.VNumber(1), mlisp.VNumber(1), mlisp.VNil()])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            b.apply([d, mlisp.VEmpty(), mlisp.VNil()])
+        # arity must match the declared types
+        with self.assertRaises(mlisp.LispError):
+            mlisp.VPrimitive('test', lambda x: x, 1, None, types=[None])
+
+    def test_max_zero(self):
+        b = mlisp.VPrimitive('test', lambda name, args: mlisp.VNumber(42), 0, 0)
+        self.assertEqual(b.apply([]).value(), 42)
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            b.apply([mlisp.VNumber(1)])
+
 
 #
 # Expressions
@@ -1987,6 +2389,276 @@ class TestOperations(TestCase):
 
 
 
+    def test_prim_vector(self):
+        v = mlisp.prim_vector('vector', [])
+        self.assertEqual(v.is_vector(), True)
+        self.assertEqual(v.value(), [])
+        v = mlisp.prim_vector('vector', [mlisp.VNumber(42), mlisp.VNumber(84)])
+        self.assertEqual(v.is_vector(), True)
+        self.assertEqual([x.value() for x in v.value()], [42, 84])
+        r = mlisp.prim_vector_ref('vector-ref', [v, mlisp.VNumber(1)])
+        self.assertEqual(r.value(), 84)
+        mlisp.prim_vector_set('vector-set!', [v, mlisp.VNumber(0), mlisp.VString('Alice')])
+        self.assertEqual(v.ref(0).value(), 'Alice')
+        self.assertEqual(mlisp.prim_vector_length('vector-length', [v]).value(), 2)
+        lst = mlisp.prim_vector_to_list('vector->list', [v])
+        self.assertEqual(lst.is_list(), True)
+        self.assertEqual([x.value() for x in lst.to_list()], ['Alice', 84])
+        v = mlisp.prim_list_to_vector('list->vector', [lst])
+        self.assertEqual([x.value() for x in v.value()], ['Alice', 84])
+        self.assertEqual(mlisp.prim_vectorp('vector?', [v]).value(), True)
+        self.assertEqual(mlisp.prim_vectorp('vector?', [lst]).value(), False)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_vector_ref('vector-ref', [lst, mlisp.VNumber(0)])
+
+
+    def test_prim_vector_sequences(self):
+        v = mlisp.VVector([mlisp.VNumber(1), mlisp.VNumber(2), mlisp.VNumber(3)])
+        add = mlisp.VPrimitive('+', mlisp.prim_plus, 0)
+        small = mlisp.VPrimitive('small', lambda name, args: mlisp.VBoolean(args[0].value() < 3), 1, 1)
+        r = mlisp.prim_map('map', [add, v, v])
+        self.assertEqual(r.is_vector(), True)
+        self.assertEqual([x.value() for x in r.value()], [2, 4, 6])
+        r = mlisp.prim_filter('filter', [small, v])
+        self.assertEqual(r.is_vector(), True)
+        self.assertEqual([x.value() for x in r.value()], [1, 2])
+        r = mlisp.prim_foldl('foldl', [add, mlisp.VNumber(10), v])
+        self.assertEqual(r.value(), 16)
+
+
+    def test_prim_dict(self):
+        d = mlisp.prim_dict('dict', [_make_list([mlisp.VNumber(1), mlisp.VNumber(42)])])
+        self.assertEqual(mlisp.prim_dictp('dict?', [d]).value(), True)
+        self.assertEqual(mlisp.prim_dict_get('dict-get', [d, mlisp.VNumber(1)]).value(), 42)
+        mlisp.prim_dict_set('dict-set!', [d, mlisp.VString('Alice'), mlisp.VNumber(84)])
+        self.assertEqual(mlisp.prim_dict_size('dict-size', [d]).value(), 2)
+        self.assertEqual(mlisp.prim_dict_has('dict-has?', [d, mlisp.VString('Alice')]).value(), True)
+        mlisp.prim_dict_remove('dict-remove!', [d, mlisp.VString('Alice')])
+        self.assertEqual(mlisp.prim_dict_has('dict-has?', [d, mlisp.VString('Alice')]).value(), False)
+        self.assertEqual(mlisp.prim_dict_size('dict-size', [d]).value(), 1)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_dict_get('dict-get', [d, mlisp.VVector([])])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_dict_size('dict-size', [mlisp.VNumber(1)])
+
+
+    def test_prim_string_join(self):
+        lst = _make_list([mlisp.VString('Alice'), mlisp.VString('Bob')])
+        v = mlisp.prim_string_join('string-join', [lst])
+        self.assertEqual(v.is_string(), True)
+        self.assertEqual(v.value(), 'AliceBob')
+        v = mlisp.prim_string_join('string-join', [lst, mlisp.VString(', ')])
+        self.assertEqual(v.value(), 'Alice, Bob')
+        v = mlisp.prim_string_join('string-join', [mlisp.VEmpty(), mlisp.VString(', ')])
+        self.assertEqual(v.value(), '')
+        v = mlisp.prim_string_join('string-join', [mlisp.VVector([mlisp.VString('a')]), mlisp.VString(', ')])
+        self.assertEqual(v.value(), 'a')
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_string_join('string-join', [_make_list([mlisp.VNumber(42)])])
+
+
+    def test_prim_string_builder(self):
+        sb = mlisp.prim_string_builder('string-builder', [])
+        self.assertEqual(mlisp.prim_string_builderp('string-builder?', [sb]).value(), True)
+        self.assertEqual(mlisp.prim_sb_to_string('sb->string', [sb]).value(), '')
+        mlisp.prim_sb_append('sb-append!', [sb, mlisp.VString('Alice'), mlisp.VString(' ')])
+        mlisp.prim_sb_append_all('sb-append-all!', [sb, _make_list([mlisp.VString('and'), mlisp.VString(' Bob')])])
+        self.assertEqual(mlisp.prim_sb_to_string('sb->string', [sb]).value(), 'Alice and Bob')
+        mlisp.prim_sb_append('sb-append!', [sb, mlisp.VString('!')])
+        self.assertEqual(mlisp.prim_sb_to_string('sb->string', [sb]).value(), 'Alice and Bob!')
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_sb_append('sb-append!', [sb, mlisp.VNumber(42)])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_sb_append('sb-append!', [mlisp.VString('Alice'), mlisp.VString('Bob')])
+
+
+    def test_prim_lazy(self):
+        def nums(v):
+            return [x.value() for x in v.to_list()]
+        s = mlisp.prim_range('range', [])
+        self.assertEqual(mlisp.prim_lazy_seqp('lazy-seq?', [s]).value(), True)
+        self.assertEqual(nums(mlisp.prim_realize('realize', [mlisp.prim_take('take', [mlisp.VNumber(3), s])])), [0, 1, 2])
+        self.assertEqual(nums(mlisp.prim_realize('realize', [mlisp.prim_range('range', [mlisp.VNumber(3)])])), [0, 1, 2])
+        self.assertEqual(nums(mlisp.prim_realize('realize', [mlisp.prim_range('range', [mlisp.VNumber(1), mlisp.VNumber(7), mlisp.VNumber(2)])])), [1, 3, 5])
+        self.assertEqual(nums(mlisp.prim_realize('realize', [mlisp.prim_range('range', [mlisp.VNumber(3), mlisp.VNumber(0), mlisp.VNumber(-1)])])), [3, 2, 1])
+        with self.assertRaises(mlisp.LispError):
+            mlisp.prim_range('range', [mlisp.VNumber(0), mlisp.VNumber(1), mlisp.VNumber(0)])
+        inc = mlisp.VPrimitive('inc', lambda name, args: mlisp.VNumber(args[0].value() + 1), 1, 1)
+        odd = mlisp.VPrimitive('odd', lambda name, args: mlisp.VBoolean(args[0].value() % 2 == 1), 1, 1)
+        s = mlisp.prim_iterate('iterate', [inc, mlisp.VNumber(10)])
+        s = mlisp.prim_drop('drop', [mlisp.VNumber(2), s])
+        self.assertEqual(mlisp.prim_first('first', [s]).value(), 12)
+        self.assertEqual(mlisp.prim_first('first', [mlisp.prim_rest('rest', [s])]).value(), 13)
+        s = mlisp.prim_lazy_map('lazy-map', [inc, mlisp.prim_range('range', [])])
+        s = mlisp.prim_lazy_filter('lazy-filter', [odd, s])
+        self.assertEqual(nums(mlisp.prim_realize('realize', [mlisp.prim_take('take', [mlisp.VNumber(3), s])])), [1, 3, 5])
+        self.assertEqual(mlisp.prim_emptyp('empty?', [mlisp.prim_range('range', [mlisp.VNumber(0)])]).value(), True)
+        self.assertEqual(mlisp.prim_emptyp('empty?', [s]).value(), False)
+        # eager sequence primitives accept lazy sequences
+        s = mlisp.prim_range('range', [mlisp.VNumber(4)])
+        self.assertEqual(nums(mlisp.prim_map('map', [inc, s])), [1, 2, 3, 4])
+        self.assertEqual(nums(mlisp.prim_filter('filter', [odd, s])), [1, 3])
+        add = mlisp.VPrimitive('+', mlisp.prim_plus, 0)
+        self.assertEqual(mlisp.prim_foldl('foldl', [add, mlisp.VNumber(0), s]).value(), 6)
+        # take and drop keep the kind of sequence
+        lst = _make_list([mlisp.VNumber(1), mlisp.VNumber(2), mlisp.VNumber(3)])
+        self.assertEqual(nums(mlisp.prim_take('take', [mlisp.VNumber(2), lst])), [1, 2])
+        self.assertEqual(nums(mlisp.prim_drop('drop', [mlisp.VNumber(2), lst])), [3])
+        self.assertEqual(mlisp.prim_drop('drop', [mlisp.VNumber(5), lst]).is_empty(), True)
+        self.assertEqual(mlisp.prim_realize('realize', [lst]), lst)
+        # counts and indices must be integers
+        half = mlisp.VNumber(1.5)
+        vec = mlisp.VVector([mlisp.VNumber(1), mlisp.VNumber(2)])
+        for (prim, args) in [(mlisp.prim_take, [half, lst]), (mlisp.prim_take, [half, vec]),
+                             (mlisp.prim_take, [half, mlisp.prim_range('range', [])]),
+                             (mlisp.prim_drop, [half, lst]), (mlisp.prim_drop, [half, mlisp.prim_range('range', [])]),
+                             (mlisp.prim_vector_ref, [vec, half]), (mlisp.prim_vector_set, [vec, half, half]),
+                             (mlisp.prim_nth, [lst, half])]:
+            with self.assertRaises(mlisp.LispWrongArgTypeError):
+                prim('prim', args)
+        # an error from the mapped function is not mistaken for the end
+        bad = mlisp.VPrimitive('bad', lambda name, args: mlisp.prim_first('first', [args[0]]), 1, 1)
+        s = mlisp.prim_lazy_map('lazy-map', [bad, mlisp.prim_range('range', [])])
+        for _ in range(2):
+            with self.assertRaises(mlisp.LispError):
+                mlisp.prim_first('first', [s])
+            with self.assertRaises(mlisp.LispError):
+                mlisp.prim_emptyp('empty?', [s])
+
+
+    def test_lazy_bounded(self):
+        # first/rest recursion over a long lazy sequence does not keep it alive
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def (sum s acc) (if (empty? s) acc (sum (rest s) (+ acc (first s)))))'))
+        v = engine.eval(engine.read('(sum (range 20000) 0)'))
+        self.assertEqual(v.value(), sum(range(20000)))
+
+
+    def test_prim_num_variadic(self):
+        nums = [mlisp.VNumber(n) for n in (1, 2, 2, 3)]
+        self.assertEqual(mlisp.prim_numless('<', nums[:2] + nums[3:]).value(), True)
+        self.assertEqual(mlisp.prim_numless('<', nums).value(), False)
+        self.assertEqual(mlisp.prim_numlesseq('<=', nums).value(), True)
+        self.assertEqual(mlisp.prim_numgreater('>', list(reversed(nums))).value(), False)
+        self.assertEqual(mlisp.prim_numgreatereq('>=', list(reversed(nums))).value(), True)
+        # all arguments are checked even when an early comparison fails
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_numless('<', [mlisp.VNumber(2), mlisp.VNumber(1), mlisp.VString('Alice')])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_numless('<', [mlisp.VNumber(2), mlisp.VString('Alice')])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_plus('+', [mlisp.VNumber(2), mlisp.VString('Alice')])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_minus('-', [mlisp.VString('Alice'), mlisp.VNumber(2)])
+        engine = mlisp.Engine()
+        self.assertEqual(engine.eval(engine.read('(< 1 2 3 4)')).value(), True)
+        self.assertEqual(engine.eval(engine.read('(> 4 3 3)')).value(), False)
+
+
+    def test_prim_sort(self):
+        def nums(v):
+            return [x.value() for x in v.to_list()]
+        lst = _make_list([mlisp.VNumber(n) for n in (3, 1, 2, 1)])
+        self.assertEqual(nums(mlisp.prim_sort('sort', [lst])), [1, 1, 2, 3])
+        less = mlisp.VPrimitive('<', mlisp.prim_numless, 2)
+        greater = mlisp.VPrimitive('>', mlisp.prim_numgreater, 2)
+        self.assertEqual(nums(mlisp.prim_sort('sort', [lst, less])), [1, 1, 2, 3])
+        self.assertEqual(nums(mlisp.prim_sort('sort', [lst, greater])), [3, 2, 1, 1])
+        v = mlisp.prim_sort('sort', [mlisp.VVector([mlisp.VString('b'), mlisp.VString('a')])])
+        self.assertEqual(str(v), '#(vector "a" "b")')
+        # user comparison and key functions
+        calls = []
+        def user_less(name, args):
+            calls.append('less')
+            return mlisp.VBoolean(args[0].value() < args[1].value())
+        def key(name, args):
+            calls.append('key')
+            return args[0].car()
+        pairs = _make_list([[mlisp.VNumber(1), mlisp.VString('b')],
+                            [mlisp.VNumber(0), mlisp.VString('c')],
+                            [mlisp.VNumber(1), mlisp.VString('a')]])
+        v = mlisp.prim_sort('sort', [pairs, mlisp.VPrimitive('less', user_less, 2, 2), mlisp.VPrimitive('key', key, 1, 1)])
+        self.assertEqual(str(v), '((0 "c") (1 "b") (1 "a"))')
+        self.assertEqual(calls.count('key'), 3)
+        calls.clear()
+        # a native comparison on keys calls back only for the keys
+        v = mlisp.prim_sort('sort', [pairs, greater, mlisp.VPrimitive('key', key, 1, 1)])
+        self.assertEqual(str(v), '((1 "b") (1 "a") (0 "c"))')
+        self.assertEqual(calls, ['key', 'key', 'key'])
+        # nil compares the keys in natural order
+        calls.clear()
+        v = mlisp.prim_sort('sort', [pairs, mlisp.VNil(), mlisp.VPrimitive('key', key, 1, 1)])
+        self.assertEqual(str(v), '((0 "c") (1 "b") (1 "a"))')
+        self.assertEqual(calls, ['key', 'key', 'key'])
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_sort('sort', [_make_list([mlisp.VNumber(1), mlisp.VString('a')])])
+
+
+    def test_prim_sequence_search(self):
+        lst = _make_list([mlisp.VNumber(n) for n in (1, 2, 3)])
+        self.assertEqual(str(mlisp.prim_member('member', [mlisp.VNumber(2), lst])), '(2 3)')
+        self.assertEqual(mlisp.prim_member('member', [mlisp.VNumber(4), lst]).value(), False)
+        vec = mlisp.VVector([mlisp.VNumber(n) for n in (1, 2, 3)])
+        self.assertEqual(str(mlisp.prim_member('member', [mlisp.VNumber(2), vec])), '#(vector 2 3)')
+        self.assertEqual(mlisp.prim_member('member', [mlisp.VNumber(4), vec]).value(), False)
+        alist = _make_list([[mlisp.VString('a'), mlisp.VNumber(1)], [mlisp.VString('b'), mlisp.VNumber(2)]])
+        self.assertEqual(str(mlisp.prim_assoc('assoc', [mlisp.VString('b'), alist])), '("b" 2)')
+        self.assertEqual(mlisp.prim_assoc('assoc', [mlisp.VString('c'), alist]).value(), False)
+        self.assertEqual(mlisp.prim_index_of('index-of', [mlisp.VNumber(3), lst]).value(), 2)
+        self.assertEqual(mlisp.prim_index_of('index-of', [mlisp.VNumber(4), lst]).value(), False)
+        self.assertEqual(mlisp.prim_last('last', [lst]).value(), 3)
+        self.assertEqual(mlisp.prim_last('last', [mlisp.VVector([mlisp.VNumber(42)])]).value(), 42)
+        with self.assertRaises(mlisp.LispError):
+            mlisp.prim_last('last', [mlisp.VEmpty()])
+        odd = mlisp.VPrimitive('odd', lambda name, args: mlisp.VBoolean(args[0].value() % 2 == 1), 1, 1)
+        self.assertEqual(mlisp.prim_count('count', [odd, lst]).value(), 2)
+        v = mlisp.prim_zip('zip', [lst, _make_list([mlisp.VString('a'), mlisp.VString('b')])])
+        self.assertEqual(str(v), '((1 "a") (2 "b"))')
+        v = mlisp.prim_zip('zip', [mlisp.VVector([mlisp.VNumber(1)]), mlisp.VVector([mlisp.VNumber(2)])])
+        self.assertEqual(str(v), '#(vector (1 2))')
+
+
+    def test_prim_append_shares_tail(self):
+        a = _make_list([mlisp.VNumber(1), mlisp.VNumber(2)])
+        b = _make_list([mlisp.VNumber(3)])
+        v = mlisp.prim_append('append', [a, mlisp.VEmpty(), b])
+        self.assertEqual(str(v), '(1 2 3)')
+        self.assertIs(v.cdr().cdr(), b)
+        self.assertEqual(str(a), '(1 2)')
+        self.assertIs(mlisp.prim_append('append', [mlisp.VEmpty(), b]), b)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_append('append', [a, mlisp.VNumber(42)])
+
+
+    def test_prim_memoize(self):
+        calls = []
+        def square(name, args):
+            calls.append(args[0].value())
+            return mlisp.VNumber(args[0].value() ** 2)
+        f = mlisp.prim_memoize('memoize', [mlisp.VPrimitive('square', square, 1, 1), mlisp.VNumber(2)])
+        self.assertEqual(f.is_function(), True)
+        for n in (1, 2, 1, 3, 2):
+            self.assertEqual(f.apply([mlisp.VNumber(n)]).value(), n * n)
+        # 2 was evicted when 3 was added, since 1 was used more recently
+        self.assertEqual(calls, [1, 2, 3, 2])
+        stats = mlisp.prim_memo_stats('memo-stats', [f])
+        self.assertEqual(stats.lookup(mlisp.VSymbol('hits')).value(), 1)
+        self.assertEqual(stats.lookup(mlisp.VSymbol('misses')).value(), 4)
+        self.assertEqual(stats.lookup(mlisp.VSymbol('size')).value(), 2)
+        self.assertEqual(stats.lookup(mlisp.VSymbol('max-size')).value(), 2)
+        mlisp.prim_memo_clear('memo-clear!', [f])
+        self.assertEqual(f.stats(), {'hits': 0, 'misses': 0, 'size': 0, 'max-size': 2})
+        # unhashable arguments are passed through
+        ident = mlisp.prim_memoize('memoize', [mlisp.VPrimitive('id', lambda name, args: args[0], 1, 1)])
+        v = mlisp.VVector([])
+        self.assertIs(ident.apply([v]), v)
+        self.assertEqual(ident.stats()['size'], 0)
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            mlisp.prim_memo_stats('memo-stats', [mlisp.VPrimitive('id', lambda name, args: args[0], 1, 1)])
+        with self.assertRaises(mlisp.LispError):
+            mlisp.prim_memoize('memoize', [ident, mlisp.VNumber(0)])
+
+
     
 #
 # Engine
@@ -2092,5 +2764,580 @@ class TestEngine(TestCase):
         self.assertEqual(engine.balance('(()'), False)
         self.assertEqual(engine.balance('( 1 2 (4)'), False)
         self.assertEqual(engine.balance('( 1 2 (()(()(('), False)
+
+
+    def test_engine_input_state(self):
+        state = mlisp.InputState()
+        self.assertEqual(state.feed('(+ 1 2) (* 3'), ['(+ 1 2)'])
+        self.assertEqual(state.pending(), True)
+        self.assertEqual(state.feed('4) abc "x y'), ['(* 3\n4)', 'abc'])
+        self.assertEqual(state.feed('z)" #true'), ['"x y\nz)"', '#true'])
+        self.assertEqual(state.pending(), False)
+        self.assertEqual(state.feed("'(a b) 'c 'd"), ["'(a b)", "'c", "'d"])
+        self.assertEqual(state.feed('#(vector 1 2)#(ref 3) "a\\"(" 5'), ['#(vector 1 2)', '#(ref 3)', '"a\\"("', '5'])
+        self.assertEqual(state.feed('(a (b'), [])
+        state.reset()
+        self.assertEqual(state.pending(), False)
+        self.assertEqual(state.feed('42'), ['42'])
     
     
+
+
+    def test_engine_read_vector(self):
+        engine = mlisp.Engine()
+        v = engine.eval(engine.read('#(vector 1 (+ 1 1) "three")'))
+        self.assertEqual(v.is_vector(), True)
+        self.assertEqual(str(v), '#(vector 1 2 "three")')
+        v = engine.eval(engine.read('(vector-ref #(vector 1 2 3) 2)'))
+        self.assertEqual(v.value(), 3)
+
+
+    def test_engine_read_pmap(self):
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def m #(pmap (1 "one") ("two" (+ 1 1))))'))
+        v = engine.eval(engine.read('(pmap-get m "two")'))
+        self.assertEqual(v.value(), 2)
+        v = engine.eval(engine.read('(pmap-size (pmap-assoc m 3 "three"))'))
+        self.assertEqual(v.value(), 3)
+        v = engine.eval(engine.read('(pmap-size (pmap-dissoc m 1))'))
+        self.assertEqual(v.value(), 1)
+        v = engine.eval(engine.read('(= m (pmap (list "two" 2) (list 1 "one")))'))
+        self.assertEqual(v.value(), True)
+
+
+    def test_engine_print_limits(self):
+        class TestEngine(mlisp.Engine):
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                self.output = []
+            def emit(self, s):
+                self.output.append(s)
+        engine = TestEngine(print_max_length=2)
+        engine.emit_value(engine.eval(engine.read('(list 1 2 3)')))
+        engine.eval(engine.read('(print "Alice" (list "Bob" 2 3))'))
+        self.assertEqual(engine.output, ['(1 2 ...)', 'Alice ("Bob" 2 ...)'])
+
+
+    def test_engine_bind_iterable(self):
+        engine = mlisp.Engine()
+        pulled = []
+        def rows():
+            for i in range(1000):
+                pulled.append(i)
+                yield {'id': i, 'name': 'row{}'.format(i)}
+        engine.bind_iterable('rows', rows())
+        v = engine.eval(engine.read('(dict-get (first (rest rows)) "name")'))
+        self.assertEqual(v.value(), 'row1')
+        self.assertEqual(pulled, [0, 1])
+        v = engine.eval(engine.read('(realize (take 3 (lazy-map (fn (r) (dict-get r "id")) rows)))'))
+        self.assertEqual([x.value() for x in v.to_list()], [0, 1, 2])
+        self.assertEqual(pulled, [0, 1, 2])
+        v = engine.eval(engine.read('(foldl (fn (acc r) (+ acc (dict-get r "id"))) 0 rows)'))
+        self.assertEqual(v.value(), sum(range(1000)))
+        # custom conversion
+        engine.bind_iterable('lines', iter(['a\n', 'b\n']), convert=lambda s: mlisp.VString(s.strip()))
+        v = engine.eval(engine.read('(map string-upper lines)'))
+        self.assertEqual([x.value() for x in v.to_list()], ['A', 'B'])
+        # the bound head keeps every element read...
+        self.assertIsNotNone(engine.eval(engine.read('rows')).value())
+        # ...unless the sequence is one-pass
+        pulled.clear()
+        seq = engine.bind_iterable('rows', rows(), cache=False)
+        v = engine.eval(engine.read('(dict-get (first rows) "id")'))
+        self.assertEqual(v.value(), 0)
+        v = engine.eval(engine.read('(dict-get (first rows) "id")'))
+        self.assertEqual(v.value(), 0)
+        v = engine.eval(engine.read('(foldl (fn (acc r) (+ acc (dict-get r "id"))) 0 rows)'))
+        self.assertEqual(v.value(), sum(range(1000)))
+        self.assertEqual(pulled, list(range(1000)))
+        self.assertIsNone(seq.value()[1].value())
+        # the traversal consumed the sequence
+        for s in ['(count (fn (r) #true) rows)', '(first rows)', '(empty? (rest rows))']:
+            with self.assertRaisesRegex(mlisp.LispError, 'already traversed'):
+                engine.eval(engine.read(s))
+        seq = engine.bind_iterable('rows', rows(), cache=False)
+        v = engine.eval(engine.read('(realize (take 2 (lazy-map (fn (r) (dict-get r "id")) rows)))'))
+        self.assertEqual([x.value() for x in v.to_list()], [0, 1])
+        self.assertIsNone(seq.value())
+        # traversals cannot share the sequence
+        engine.bind_iterable('rows', rows(), cache=False)
+        with self.assertRaisesRegex(mlisp.LispError, 'already traversed'):
+            engine.eval(engine.read('(map (fn (a b) a) rows rows)'))
+
+
+    def test_engine_positional_primitive(self):
+        engine = mlisp.Engine()
+        engine.def_primitive('add1', lambda n: mlisp.VNumber(n.value() + 1), 1, 1, types=[mlisp.TAG_NUMBER])
+        engine.def_primitive('pair', lambda a, b: mlisp.Value.from_tree([a, b]), 2, 2, types=[None, None])
+        engine.def_primitive('triple', lambda a, b, c: mlisp.Value.from_tree([a, b, c]), 3, 3, types=[None, None, mlisp.TAG_STRING])
+        engine.def_primitive('zero', lambda: mlisp.VNumber(0), 0, 0, types=[])
+        self.assertEqual(engine.eval(engine.read('(add1 (add1 (zero)))')).value(), 2)
+        self.assertEqual(str(engine.eval(engine.read('(pair 1 (add1 1))'))), '(1 2)')
+        self.assertEqual(str(engine.eval(engine.read('(triple 1 2 "c")'))), '(1 2 "c")')
+        self.assertEqual(str(engine.eval(engine.read('(map add1 (list 1 2))'))), '(2 3)')
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            engine.eval(engine.read('(add1 "Alice")'))
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            engine.eval(engine.read('(add1 1 2)'))
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            engine.eval(engine.read('(triple 1 2 3)'))
+
+
+    def test_engine_defmemo(self):
+        engine = mlisp.Engine(memo_max_size=10)
+        engine.eval(engine.read('(defmemo (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'))
+        v = engine.eval(engine.read('(fib 60)'))
+        self.assertEqual(v.value(), 1548008755920)
+        stats = engine.eval(engine.read('fib')).stats()
+        self.assertEqual(stats['misses'], 61)
+        self.assertEqual(stats['max-size'], 10)
+        self.assertEqual(stats['size'], 10)
+        (kind, result) = engine.parser().parse(engine.read('(defmemo (f a b) a)'))
+        self.assertEqual(kind, 'defmemo')
+        self.assertEqual(result[:2], ('f', ['a', 'b']))
+
+
+    def test_engine_apply_tail_call(self):
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def (count n acc) (if (= n 0) acc (apply count (list (- n 1) (+ acc 1)))))'))
+        v = engine.eval(engine.read('(count 20000 0)'))
+        self.assertEqual(v.value(), 20000)
+        # tail calls through several primitives in a row
+        engine.eval(engine.read('(def (ev? n) (if (= n 0) #true (apply apply (list od? (list (- n 1))))))'))
+        engine.eval(engine.read('(def (od? n) (if (= n 0) #false (apply ev? (list (- n 1)))))'))
+        v = engine.eval(engine.read('(ev? 10001)'))
+        self.assertEqual(v.value(), False)
+        v = engine.eval(engine.read('(apply + (list 1 2 3))'))
+        self.assertEqual(v.value(), 6)
+        # host primitives can use the same protocol
+        engine.def_primitive('call-with', lambda name, args: args[0].apply(args[1:]), 1, None,
+                             tail=lambda name, args: (args[0], args[1:]))
+        v = engine.eval(engine.read('(call-with (fn (a b) (- a b)) 42 2)'))
+        self.assertEqual(v.value(), 40)
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            engine.eval(engine.read('(apply +)'))
+        with self.assertRaises(mlisp.LispError):
+            engine.eval(engine.read('(apply 42 (list))'))
+
+
+    def test_engine_import_module(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lib = os.path.join(tmp, 'lib.lisp')
+            with open(lib, 'w') as f:
+                f.write('(def (sq x) (* x x))\n(def base (let ((a 10)) (+ a 1)))\n(def counter (ref 0))')
+            with open(os.path.join(tmp, 'main.lisp'), 'w') as f:
+                f.write('(import "lib.lisp") (def top (sq base))')
+            engine = mlisp.Engine()
+            engine.eval(engine.read('(import "{}")'.format(os.path.join(tmp, 'main.lisp'))))
+            self.assertEqual(engine.eval(engine.read('top')).value(), 121)
+            self.assertEqual(engine.eval(engine.read('(sq 3)')).value(), 9)
+            # a second import shares the bindings of the first
+            engine.eval(engine.read('(ref-set! counter 42)'))
+            env = engine.import_module(lib)
+            self.assertEqual(env.lookup('counter').value().value(), 42)
+            self.assertTrue(os.path.exists(os.path.join(tmp, '__mlispcache__', 'lib.lisp.pickle')))
+            # a new engine reads the expanded forms from the cache
+            engine = mlisp.Engine()
+            def fail(sexp):
+                raise AssertionError('module was parsed again')
+            engine.parser().parse = fail
+            env = engine.import_module(lib)
+            self.assertEqual(env.lookup('base').value(), 11)
+            # a cache that others can write to is not trusted
+            cache = os.path.join(tmp, '__mlispcache__', 'lib.lisp.pickle')
+            if hasattr(os, 'getuid'):
+                os.chmod(cache, 0o666)
+                engine = mlisp.Engine()
+                parsed = []
+                parse = engine.parser().parse
+                engine.parser().parse = lambda sexp: parsed.append(sexp) or parse(sexp)
+                env = engine.import_module(lib)
+                self.assertEqual(env.lookup('base').value(), 11)
+                self.assertEqual(len(parsed), 3)
+            # changing the source or the macros invalidates the cache
+            with open(lib, 'a') as f:
+                f.write('\n(def extra 1)')
+            engine = mlisp.Engine()
+            engine.import_module(lib)
+            self.assertEqual(engine.eval(engine.read('extra')).value(), 1)
+            engine = mlisp.Engine()
+            version = engine.macro_version()
+            engine.register_macro('twice', lambda parser, name, args: args)
+            self.assertNotEqual(engine.macro_version(), version)
+            # so does bumping the version of a macro that keeps its name
+            with open(os.path.join(tmp, 'answer.lisp'), 'w') as f:
+                f.write('(def v (answer))')
+            def answer(n):
+                return lambda parser, name, args: mlisp.VNumber(n)
+            for (n, version) in ((42, 1), (63, 2)):
+                other = mlisp.Engine()
+                other.register_macro('answer', answer(n), version=version)
+                env = other.import_module(os.path.join(tmp, 'answer.lisp'))
+                self.assertEqual(env.lookup('v').value(), n)
+            other = mlisp.Engine()
+            other.register_macro('answer', answer(63), version=2)
+            other.parser().parse = fail
+            env = other.import_module(os.path.join(tmp, 'answer.lisp'))
+            self.assertEqual(env.lookup('v').value(), 63)
+            # loading a large module without a cache takes linear time
+            def cold_load(n):
+                path = os.path.join(tmp, 'big{}.lisp'.format(n))
+                with open(path, 'w') as f:
+                    f.write('\n'.join('(def (f{} x) (let ((y "{}")) (list x y)))'.format(i, 'x' * 500) for i in range(n)))
+                other = mlisp.Engine()
+                start = time.perf_counter()
+                env = other.import_module(path)
+                elapsed = time.perf_counter() - start
+                self.assertEqual(env.lookup('f{}'.format(n - 1)).apply([mlisp.VNumber(n)]).car().value(), n)
+                return elapsed
+            self.assertLess(cold_load(2000), cold_load(500) * 10)
+            with open(os.path.join(tmp, 'loop.lisp'), 'w') as f:
+                f.write('(import "loop.lisp")')
+            with self.assertRaises(mlisp.LispError):
+                engine.import_module(os.path.join(tmp, 'loop.lisp'))
+            with self.assertRaises(mlisp.LispError):
+                engine.import_module(os.path.join(tmp, 'missing.lisp'))
+
+
+    def test_engine_serve(self):
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def shared 42)'))
+        released = threading.Event()
+        engine.def_primitive('wait', lambda name, args: mlisp.VBoolean(released.wait(10)), 0, 0)
+        engine.def_primitive('release', lambda name, args: released.set() or mlisp.VNil(), 0, 0)
+        async def send(reader, writer, line, prompt=b'> '):
+            writer.write((line + '\n').encode('utf-8'))
+            return (await reader.readuntil(prompt)).decode('utf-8')
+        async def sessions(connect):
+            (r1, w1) = await connect()
+            (r2, w2) = await connect()
+            await r1.readuntil(b'> ')
+            await r2.readuntil(b'> ')
+            self.assertEqual(await send(r1, w1, '(def x 1) (+ x shared)'), ';; x\n43\n> ')
+            self.assertEqual(await send(r2, w2, '(list 1', b'. '), '. ')
+            self.assertEqual(await send(r2, w2, '2)'), '(1 2)\n> ')
+            self.assertIn('Cannot find binding', await send(r2, w2, 'x'))
+            # a session blocked in evaluation does not hold up the others
+            w1.write(b'(wait)\n')
+            self.assertEqual(await send(r2, w2, '(release)'), '> ')
+            self.assertEqual((await r1.readuntil(b'> ')).decode('utf-8'), '#true\n> ')
+            # lines longer than asyncio's default limit of 64 KiB are accepted
+            self.assertEqual(await send(r1, w1, '(string-length "{}")'.format('x' * 70000)), '70000\n> ')
+            w1.close()
+            w2.close()
+        async def tcp():
+            server = await engine.start_server('127.0.0.1', 0, max_workers=2)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                await sessions(lambda: asyncio.open_connection('127.0.0.1', port))
+            # the thread pool is shut down once the server and its sessions are closed
+            for _ in range(100):
+                if not engine._server_tasks:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(engine._server_tasks, set())
+        asyncio.run(tcp())
+        async def limited():
+            server = await engine.start_server('127.0.0.1', 0, line_limit=1000)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                (r, w) = await asyncio.open_connection('127.0.0.1', port)
+                await r.readuntil(b'> ')
+                # a line over the limit is reported, and the session goes on
+                self.assertEqual(await send(r, w, '(list 1', b'. '), '. ')
+                self.assertIn('Input line longer than 1000 bytes', await send(r, w, '"{}"'.format('x' * 5000)))
+                self.assertEqual(await send(r, w, '(+ 1 2)'), '3\n> ')
+                w.write('"{}'.format('x' * 5000).encode('utf-8'))
+                w.write_eof()
+                self.assertIn('Input line longer', (await r.read()).decode('utf-8'))
+                w.close()
+        asyncio.run(limited())
+        released.clear()
+        async def unix(path):
+            server = await engine.start_unix_server(path, max_workers=2)
+            async with server:
+                await sessions(lambda: asyncio.open_unix_connection(path))
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(unix(os.path.join(tmp, 'repl.sock')))
+        # eval can also evaluate in a given environment
+        self.assertEqual(engine.eval(engine.read('x'), env=mlisp.Environment(bindings=[('x', mlisp.VNumber(1))])).value(), 1)
+
+
+    def test_engine_eval_script(self):
+        engine = mlisp.Engine()
+        result = engine.eval_script('(def x 40)\n(+ x 2) (car 1) "done"')
+        self.assertEqual([ f.source for f in result.forms ], ['(def x 40)', '(+ x 2)', '(car 1)', '"done"'])
+        self.assertEqual([ str(v) for v in result.values() ], ['#nil', '42', '"done"'])
+        self.assertEqual(len(result.errors()), 1)
+        self.assertEqual(result.ok(), False)
+        self.assertEqual(result.value().value(), 'done')
+        self.assertIsInstance(result.forms[2].error, mlisp.LispError)
+        for f in result.forms:
+            self.assertTrue(f.read_time >= 0 and f.parse_time >= 0 and f.eval_time >= 0)
+        self.assertEqual(result.slowest(1)[0] in result.forms, True)
+        result = engine.eval_script('(car 1) 42', stop_on_error=True)
+        self.assertEqual(len(result.forms), 1)
+        # a read error stops the script
+        result = engine.eval_script('1 2 )')
+        self.assertEqual(result.values()[-1].value(), 2)
+        self.assertIsInstance(result.errors()[0], mlisp.LispReadError)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / 'script.lisp'
+            path.write_text('(def y 1) (+ y 1)')
+            self.assertEqual(engine.eval_script(path).value().value(), 2)
+            with open(path) as f:
+                self.assertEqual(engine.eval_script(f).value().value(), 2)
+        results = engine.eval_many(['(def z 1)', '(+ z 1)', ''])
+        self.assertEqual([ str(r.value()) for r in results ], ['#nil', '2', '#nil'])
+
+
+    def test_engine_read_many_forms(self):
+        # reading a script takes time linear in its number of forms
+        engine = mlisp.Engine()
+        def script(n):
+            return '\n'.join('(def v{} "{}")'.format(i, 'x' * 1000) for i in range(n))
+        def timed(f, n):
+            source = script(n)
+            start = time.perf_counter()
+            f(source)
+            return time.perf_counter() - start
+        for f in (engine.read_all, engine.eval_script):
+            small = timed(f, 500)
+            large = timed(f, 2000)
+            self.assertLess(large, small * 10)
+        self.assertEqual(len(engine.read_all(script(3000))), 3000)
+        self.assertEqual([ str(v) for v in engine.read_all("'a #true (b \"c\") 1") ], ['(quote a)', '#true', '(b "c")', '1'])
+        with self.assertRaises(mlisp.LispReadError):
+            engine.read_all('(a) (b')
+
+
+    def test_engine_call_get(self):
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def (greet name items) (list name (dict-size items) (dict-get items "a")))'))
+        engine.eval(engine.read('(def limit 10)'))
+        self.assertEqual(engine.call('greet', 'Alice', {'a': [1, None], 'b': 2}), ['Alice', 2, [1, None]])
+        self.assertEqual(engine.call('+', 1, 2, 3), 6)
+        self.assertEqual(engine.call('first', [1, 2]), 1)
+        self.assertEqual(engine.get('limit'), 10)
+        self.assertEqual(engine.get('empty'), [])
+        self.assertIsInstance(engine.get('greet'), mlisp.VFunction)
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            engine.call('greet', 'Alice')
+        with self.assertRaises(mlisp.LispError):
+            engine.call('limit', 1)
+        with self.assertRaises(mlisp.LispError):
+            engine.get('missing')
+
+
+    def test_engine_pyobject(self):
+        engine = mlisp.Engine()
+        class Point:
+            def __init__(self, x):
+                self.x = x
+            def scale(self, k):
+                return Point(self.x * k)
+        payload = {'users': [{'name': 'Alice', 'tags': ['a', 'b']}, {'name': 'Bob', 'tags': []}],
+                   'point': Point(3), 'keys': {'k1': 1, 'k2': 2}}
+        engine.def_value('payload', mlisp.VPyObject(payload))
+        def run(s):
+            return engine.eval(engine.read(s))
+        self.assertEqual(run('(py-get payload "users" 1 "name")').value(), 'Bob')
+        self.assertEqual(run('(py-len (py-get payload "users"))').value(), 2)
+        self.assertEqual(run('(length (py-get payload "users"))').value(), 2)
+        self.assertEqual(run('(py-get (first (py-get payload "users")) "name")').value(), 'Alice')
+        self.assertEqual(run('(nth (py-get payload "users" 0 "tags") 1)').value(), 'b')
+        self.assertEqual(run('(nth (py-get payload "keys") 1)').value(), 'k2')
+        self.assertEqual(str(run('(map (fn (u) (py-get u "name")) (py-get payload "users"))')), '("Alice" "Bob")')
+        self.assertEqual(run('(foldl (fn (acc u) (+ acc (py-len (py-get u "tags")))) 0 (py-get payload "users"))').value(), 2)
+        self.assertEqual(str(run('(filter (fn (k) (= k "k2")) (py-get payload "keys"))')), '("k2")')
+        self.assertEqual(str(run('(realize (py-iter (py-get payload "users" 0 "tags")))')), '("a" "b")')
+        self.assertEqual(run('(py-get (py-call (py-get payload "point" "scale") 2) "x")').value(), 6)
+        self.assertEqual(run('(py-object? payload)').value(), True)
+        self.assertIs(run('(py-get payload "users" 0)').value(), payload['users'][0])
+        with self.assertRaises(mlisp.LispError):
+            run('(py-get payload "missing")')
+        with self.assertRaises(mlisp.LispError):
+            run('(nth (py-get payload "users") 5)')
+        with self.assertRaises(mlisp.LispError):
+            run('(py-call (py-get payload "point" "scale") "x" "y")')
+        with self.assertRaises(mlisp.LispWrongArgTypeError):
+            run('(py-call payload)')
+        # private and special attributes are out of reach
+        with self.assertRaises(mlisp.LispError):
+            run('(py-get (py-get payload "point") "__class__")')
+        with self.assertRaises(mlisp.LispError):
+            run('(py-get payload "point" "__init__" "__globals__")')
+        with self.assertRaises(mlisp.LispError):
+            run('(py-get payload "point" "_hidden")')
+        # truth values, first and rest follow Python's containers
+        self.assertEqual(run('(if (py-get payload "users" 1 "tags") 1 2)').value(), 2)
+        self.assertEqual(run('(if (py-get payload "users") 1 2)').value(), 1)
+        self.assertEqual(run('(empty? (py-get payload "users" 1 "tags"))').value(), True)
+        self.assertEqual(run('(empty? (py-get payload "users"))').value(), False)
+        self.assertEqual(str(run('(realize (rest (py-get payload "users" 0 "tags")))')), '("b")')
+        with self.assertRaises(mlisp.LispError):
+            run('(rest (py-get payload "users" 1 "tags"))')
+        # iterators are read once, through lazy sequences
+        engine.def_value('numbers', mlisp.VPyObject({'gen': lambda: (i * i for i in range(4))}))
+        run('(def squares (py-call (py-get numbers "gen")))')
+        self.assertEqual(run('(lazy-seq? squares)').value(), True)
+        self.assertEqual(run('(first squares)').value(), 0)
+        self.assertEqual(run('(first squares)').value(), 0)
+        self.assertEqual(str(run('(realize (rest squares))')), '(1 4 9)')
+        engine.def_value('it', mlisp.VPyObject(iter([1, 2])))
+        for s in ['(first it)', '(rest it)', '(nth it 0)', '(empty? it)']:
+            with self.assertRaises(mlisp.LispError):
+                run(s)
+        self.assertEqual(str(run('(realize (py-iter it))')), '(1 2)')
+
+
+    def test_engine_prepare(self):
+        engine = mlisp.Engine()
+        engine.eval(engine.read('(def limit 10)'))
+        check = engine.prepare('(and (> (length items) 0) (< (length items) limit))', params=['Items'])
+        self.assertEqual(check.params(), ['items'])
+        self.assertEqual(check([1, 2]), True)
+        self.assertEqual(check(items=list(range(20))), False)
+        self.assertEqual(check.run([mlisp.VEmpty()]).is_true(), False)
+        # definitions stay local to each call
+        script = engine.prepare('(def (sq x) (* x x)) (def y (sq n)) (+ y 1)', params=['n'])
+        self.assertEqual(script(3), 10)
+        self.assertEqual(script(4), 17)
+        with self.assertRaises(mlisp.LispError):
+            engine.eval(engine.read('y'))
+        # parsing happens once
+        def fail(sexp):
+            raise AssertionError('script was parsed again')
+        engine.parser().parse = fail
+        self.assertEqual(check([1]), True)
+        self.assertEqual(engine.prepare('', params=[])(), None)
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            check()
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            check([1], 2)
+        with self.assertRaises(mlisp.LispWrongArgNoError):
+            check(items=[1], other=2)
+
+
+    def test_engine_specialize_hot_function(self):
+        engine = mlisp.Engine()
+        def run(s):
+            return engine.eval(engine.read(s))
+        run('(def (inc x) (+ x 1))')
+        run('(def (f x) (letrec ((y (* x 2))) (if (> y 0) (inc y) (- y))))')
+        f = run('f')
+        self.assertEqual(run('(foldl + 0 (map f (take 150 (range))))').value(), 22499)
+        self.assertEqual(f.is_specialized(), True)
+        self.assertEqual(run('(f 5)').value(), 11)
+        self.assertEqual(run('(f -5)').value(), 10)
+        # redefining a global the function depends on reverts it
+        run('(def (inc x) (+ x 100))')
+        self.assertEqual(f.is_specialized(), False)
+        self.assertEqual(run('(f 5)').value(), 110)
+        run('(foldl + 0 (map f (take 150 (range))))')
+        self.assertEqual(f.is_specialized(), True)
+        # so does redefining an inlined primitive
+        run('(def * (fn (a b) 0))')
+        self.assertEqual(f.is_specialized(), False)
+        self.assertEqual(run('(f 5)').value(), 0)
+        # deep tail recursion still runs in constant stack
+        run('(def (count n acc) (if (= n 0) acc (count (- n 1) (+ acc 1))))')
+        self.assertEqual(run('(count 20000 0)').value(), 20000)
+        self.assertEqual(run('count').is_specialized(), True)
+        g = run('(fn (x) x)')
+        g.hot_threshold = None
+        for i in range(200):
+            g.apply([mlisp.VNumber(i)])
+        self.assertEqual(g.is_specialized(), False)
+
+
+    def test_engine_fuel(self):
+        engine = mlisp.Engine()
+        def run(s, **kwargs):
+            return engine.eval(engine.read(s), **kwargs)
+        run('(def (forever n) (forever (+ n 1)))')
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(forever 0)', fuel=10000)
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((i 0)) (again (+ i 1)))', fuel=1000)
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(map (fn (x) (forever x)) (list 1 2))', fuel=1000)
+        # loops inside primitives over infinite sequences
+        for s in ['(last (range))', '(foldl + 0 (range))', '(count number? (range))', '(realize (range))',
+                  '(first (lazy-filter nil? (range)))']:
+            with self.assertRaises(mlisp.LispResourceError):
+                run(s, fuel=1000)
+        # enough fuel, and no fuel at all
+        self.assertEqual(run('(foldl + 0 (list 1 2 3))', fuel=100).value(), 6)
+        self.assertEqual(run('(loop again ((i 0)) (if (< i 1000) (again (+ i 1)) i))').value(), 1000)
+        with self.assertRaises(mlisp.LispResourceError):
+            engine.call('forever', 0, fuel=1000)
+        result = engine.eval_script('(def a 1) (forever a) (def b 2)', fuel=1000)
+        self.assertIsInstance(result.errors()[0], mlisp.LispResourceError)
+        self.assertEqual(len(result.forms), 2)
+        # a nested budget is charged to the enclosing one
+        engine.def_primitive('eval-with-fuel', lambda name, args: engine.eval(args[0], fuel=args[1].value()), 2, 2)
+        with self.assertRaises(mlisp.LispResourceError):
+            run("(eval-with-fuel '(forever 0) 1000000)", fuel=1000)
+        self.assertEqual(run("(eval-with-fuel '(+ 1 2) 1000)", fuel=1000).value(), 3)
+        # a default budget for every evaluation
+        engine = mlisp.Engine(max_steps=1000)
+        engine.eval(engine.read('(def (forever n) (forever (+ n 1)))'))
+        with self.assertRaises(mlisp.LispResourceError):
+            engine.eval(engine.read('(forever 0)'))
+        script = engine.prepare('(forever n)', params=['n'])
+        with self.assertRaises(mlisp.LispResourceError):
+            script(0)
+
+
+    def test_engine_allocation_quotas(self):
+        engine = mlisp.Engine(max_cons_cells=1000, max_string_chars=10000, max_dict_entries=100)
+        def run(s):
+            return engine.eval(engine.read(s))
+        with self.assertRaises(mlisp.LispResourceError):
+            run("(loop again ((l '()) (i 0)) (again (append l (list i)) (+ i 1)))")
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((l empty)) (again (cons 1 l)))')
+        engine.def_value('big', mlisp.Value.from_python(list(range(2000))))
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(reverse big)')
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((s "")) (again (string-append s "abcdefghij")))')
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((sb (string-builder))) (again (do (sb-append! sb "abcdefghij") sb)))')
+        run('(def d (dict))')
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((i 0)) (again (do (dict-set! d i i) (+ i 1))))')
+        with self.assertRaises(mlisp.LispResourceError):
+            run('(loop again ((m (pmap)) (i 0)) (again (pmap-assoc m i i) (+ i 1)))')
+        # lists built from infinite sequences trip the quota as they grow
+        for s in ['(realize (range))', '(map (fn (x) x) (range))', '(filter number? (range))',
+                  '(zip (range) (range))', '(take 1500 big)']:
+            with self.assertRaises(mlisp.LispResourceError):
+                run(s)
+        # vector slots count as cons cells
+        engine.def_value('bigv', mlisp.VVector([ mlisp.VNumber(i) for i in range(2000) ]))
+        for s in ['(vector->list bigv)', '(list->vector big)', '(map (fn (x) x) bigv)', '(sort bigv)', '(take 1500 bigv)']:
+            with self.assertRaises(mlisp.LispResourceError):
+                run(s)
+        # string literals are built when parsing, not charged when evaluated
+        # so accounting is the same whether or not a function got hot
+        small = mlisp.Engine(max_string_chars=1000)
+        for threshold in (None, 100):
+            small.eval(small.read('(def (name-of d) (dict-get d "name"))'))
+            small.eval(small.read('name-of')).hot_threshold = threshold
+            small.eval(small.read('(def people (dict (list "name" "Alice")))'))
+            v = small.eval(small.read('(foldl (fn (acc i) (name-of people)) "" (take 400 (range)))'))
+            self.assertEqual(v.value(), 'Alice')
+        self.assertEqual(small.eval_script('(string-length "' + 'a' * 5000 + '")').value().value(), 5000)
+        # quotas apply to each evaluation separately
+        self.assertEqual(run('(length (map (fn (x) (+ x 1)) (list 1 2 3)))').value(), 3)
+        self.assertEqual(run('(do (dict-set! d 0 1) (dict-set! d 0 2) (dict-get d 0))').value(), 2)
+        self.assertEqual(run('(string-append "a" "b")').value(), 'ab')
+        result = engine.eval_script('(def l (list 1 2)) (length (reverse big)) (length l)')
+        self.assertIsInstance(result.errors()[0], mlisp.LispResourceError)
+        self.assertEqual(len(result.forms), 2)
+        # without quotas nothing is counted
+        engine = mlisp.Engine()
+        engine.def_value('big', mlisp.Value.from_python(list(range(2000))))
+        self.assertEqual(engine.eval(engine.read('(length (reverse big))')).value(), 2000)